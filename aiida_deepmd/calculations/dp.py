@@ -12,11 +12,67 @@ import numpy as np
 
 from aiida.engine import CalcJob
 from aiida import orm
-from aiida.orm.nodes.data.singlefile import SinglefileData
 from aiida.common import CalcInfo, CodeInfo, InputValidationError
+from aiida_deepmd.data.structure_set import StructureSet
 from warnings import warn
 
 
+def _get_file_hash(filepath, blocksize=2**20):
+    """Return the sha256 hex digest of the content of a file."""
+    import hashlib
+
+    sha = hashlib.sha256()
+    with io.open(filepath, mode='rb') as fobj:
+        for block in iter(lambda: fobj.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _get_tree_hash(datadirs):
+    """Return the sha256 hex digest of the relative paths and the contents of the files of directories.
+
+    The directories are named by their basename, as in :py:meth:`DpCalculation.get_data_folder`.
+    """
+    import hashlib
+
+    sha = hashlib.sha256()
+    for datadir in datadirs:
+        absdatadir = os.path.abspath(datadir)
+        for root, directories, files in os.walk(top=absdatadir, topdown=True):
+            directories.sort()
+            for name in sorted(files):
+                relpath = os.path.join(os.path.basename(absdatadir), os.path.relpath(os.path.join(root, name), absdatadir))
+                sha.update(relpath.encode('utf-8'))
+                sha.update(_get_file_hash(os.path.join(root, name)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _copy_folder_data(node, folder, path=None):
+    """Copy the files of a FolderData under ``path`` into a sandbox folder, return their relative paths."""
+    import shutil
+    from aiida.repository import FileType
+
+    relpaths = []
+    for obj in node.list_objects(path):
+        relpath = obj.name if path is None else os.path.join(path, obj.name)
+        if obj.type == FileType.DIRECTORY:
+            folder.get_subfolder(relpath, create=True)
+            relpaths.extend(_copy_folder_data(node, folder, relpath))
+        else:
+            with node.open(relpath, mode='rb') as source, io.open(folder.get_abs_path(relpath), mode='wb') as target:
+                shutil.copyfileobj(source, target)
+            relpaths.append(relpath)
+    return relpaths
+
+
+def _pack_files(basepath, relpaths, filepath):
+    """Pack the files of relative paths ``relpaths`` in ``basepath`` in the tar archive ``filepath``."""
+    import tarfile
+
+    with tarfile.open(filepath, mode='w') as archive:
+        for relpath in relpaths:
+            archive.add(os.path.join(basepath, relpath), arcname=relpath)
+
 
 class DpCalculation(CalcJob):
     """
@@ -37,11 +93,17 @@ class DpCalculation(CalcJob):
     _DEFAULT_CHECK_META_FILE = 'model.ckpt.meta'
     _DEFAULT_CHECK_INDEX_FILE = 'model.ckpt.index'
     _DEFAULT_CHECK_META_PREFIX = 'model.ckpt.data'
+    _TRAINING_DATA_SUBFOLDER = 'training_data'
+    _REMOTE_DATA_SUBFOLDER = 'remote_data'
+    _PACKED_DATA_FILE = 'training_data.tar'
 
     # Defaults for freeze
     _DEFAULT_FREEZE_OUTPUT_FILE = 'model.pb'
     _DEFAULT_PARENT_CALC_FLDR_NAME = './'
 
+    # the extra holding the content hash of the FolderData of the training files
+    _CONTENT_HASH_EXTRA = 'deepmd_content_hash'
+
     @classmethod
     def define(cls, spec):
         super(DpCalculation, cls).define(spec)
@@ -52,11 +114,25 @@ class DpCalculation(CalcJob):
         spec.input('loss', valid_type=orm.Dict, help='parameters of loss function')
         spec.input('training', valid_type=orm.Dict, help='parameters of training')
 
-        spec.input('datadirs', valid_type=list, help='parameters of datadirs', non_db=True)
-
-        # a special datatype is need to write the files for training and then uploaded
+        spec.input('data_folder', valid_type=orm.FolderData, required=False,
+                   help='the training data, each top folder a DeePMD-kit system, see `get_data_folder`')
+        spec.input_namespace('training_data', valid_type=StructureSet, dynamic=True, required=False,
+                             help='the labelled structure sets, written as DeePMD-kit systems in the working '
+                             'directory and added to the training systems')
+        spec.input_namespace('remote_data', valid_type=orm.RemoteData, dynamic=True, required=False,
+                             help='directories already on the computer of the calculation, linked (or copied) '
+                             'in the working directory; each is one DeePMD-kit system added to the training '
+                             'systems, unless its systems are listed in remote_systems')
+        spec.input_namespace('remote_systems', valid_type=orm.List, dynamic=True, required=False,
+                             help='the paths of the DeePMD-kit systems in the remote_data directory of the same '
+                             'name, relative to it, added to the training systems instead of the directory')
 
         spec.input('metadata.options.withmpi', valid_type=bool, default=False)
+        spec.input('metadata.options.symlink_remote_data', valid_type=bool, default=True,
+                   help='symlink the remote_data directories, copy them on the remote computer if False')
+        spec.input('metadata.options.pack_training_data', valid_type=bool, default=False,
+                   help='upload the data_folder and training_data files as one tar archive, unpacked on the '
+                   'remote computer before the job runs')
 
         # Exit codes
         spec.exit_code(100,
@@ -68,6 +144,42 @@ class DpCalculation(CalcJob):
         spec.output('folder', valid_type=orm.FolderData, required=True, help='the folder contain the meta files')
         # spec.default_output_node = 'output_parameters'
 
+    @classmethod
+    def get_data_folder(cls, datadirs):
+        """Return a stored FolderData of the training data, reusing the node of identical content.
+
+        Each directory is put in the folder under its basename, e.g. ``train_data/set.000/box.npy``,
+        and is copied under this name in the working directory of the calculation. The sha256 of the
+        files is kept in the ``_CONTENT_HASH_EXTRA`` extra of the nodes stored here, so resubmitting
+        the same data costs the hashing of the files and one query.
+
+        The lookup is a best-effort cache: extras are mutable and outside the provenance, so a node
+        whose extra was removed is not reused, and a node whose extra was edited to the hash of other
+        data would be. The reuse is for the whole tree: if any file differs, a new node is stored with
+        all the files, as the repository keeps the files of each node apart. Reusing a node per file,
+        as one SinglefileData per file did, is given up for one node and one tree copy per dataset.
+
+        :param datadirs: the list of the DeePMD-kit system directories.
+        :return: a stored FolderData.
+        """
+        for datadir in datadirs:
+            if not os.path.isdir(datadir):
+                raise FileNotFoundError("the datadir {} does not exist".format(datadir))
+        content_hash = _get_tree_hash(datadirs)
+
+        query = orm.QueryBuilder()
+        query.append(orm.FolderData, filters={'extras.{}'.format(cls._CONTENT_HASH_EXTRA): content_hash})
+        existing = query.first()
+        if existing:
+            return existing[0]
+
+        data_folder = orm.FolderData()
+        for datadir in datadirs:
+            absdatadir = os.path.abspath(datadir)
+            data_folder.put_object_from_tree(absdatadir, os.path.basename(absdatadir))
+        data_folder.set_extra(cls._CONTENT_HASH_EXTRA, content_hash)
+        return data_folder.store()
+
     def prepare_for_submission(self, folder):
         """Create the input files from the input nodes passed to this instance of the `CalcJob`.
 
@@ -86,6 +198,77 @@ class DpCalculation(CalcJob):
         input['model']['fitting_net']['seed'] = np.random.randint(100000000)
         input['training']['seed'] = np.random.randint(100000000)
         warn("All seeds in user input will be automatically replaced by numpy.")
+
+        training_data = self.inputs.get('training_data', {})
+        remote_data = self.inputs.get('remote_data', {})
+        if 'data_folder' not in self.inputs and not training_data and not remote_data:
+            raise InputValidationError("one of data_folder, training_data or remote_data must be given")
+
+        # copy the training data as one tree, leaving it out of the repository of the calculation
+        # since the data_folder input already keeps it
+        provenance_exclude_list = []
+        systems = []
+        if 'data_folder' in self.inputs:
+            data_folder = self.inputs.data_folder
+            provenance_exclude_list.extend(_copy_folder_data(data_folder, folder))
+            systems.extend(sorted(name for name in data_folder.list_object_names()
+                                  if os.path.isdir(folder.get_abs_path(name))))
+        # the user may choose the systems of the data_folder, not the ones of the structure sets
+        systems = list(input['training'].get('systems', systems))
+
+        # write the structure sets straight into the working directory, with the type map of the model
+        if training_data:
+            type_map = input['model'].get('type_map')
+            if type_map is None:
+                from ase.data import atomic_numbers
+                elements = set().union(*(x.get_elements() for x in training_data.values()))
+                type_map = sorted(elements, key=atomic_numbers.get)
+                input['model']['type_map'] = type_map
+            for name, structure_set in sorted(training_data.items()):
+                subfolder = folder.get_subfolder(os.path.join(self._TRAINING_DATA_SUBFOLDER, name), create=True)
+                try:
+                    system_dirs = structure_set.export_deepmd(subfolder.abspath, type_map=type_map)
+                except ValueError as exc:
+                    raise InputValidationError("training_data.{}: {}".format(name, exc))
+                for system_dir in system_dirs:
+                    systems.append(os.path.relpath(system_dir, folder.abspath))
+                for root, _, files in os.walk(subfolder.abspath):
+                    provenance_exclude_list.extend(
+                        os.path.relpath(os.path.join(root, filename), folder.abspath) for filename in files)
+
+        # the remote datasets never leave the computer, they are linked or copied there
+        remote_list = []
+        remote_systems = self.inputs.get('remote_systems', {})
+        for name in remote_systems:
+            if name not in remote_data:
+                raise InputValidationError("remote_systems.{0} is given without remote_data.{0}".format(name))
+        if remote_data:
+            folder.get_subfolder(self._REMOTE_DATA_SUBFOLDER, create=True)
+        for name, remote in sorted(remote_data.items()):
+            if remote.computer.uuid != self.node.computer.uuid:
+                raise InputValidationError("remote_data.{} is not on the computer of the calculation".format(name))
+            dst_path = os.path.join(self._REMOTE_DATA_SUBFOLDER, name)
+            remote_list.append((remote.computer.uuid, remote.get_remote_path(), dst_path))
+            if name not in remote_systems:
+                systems.append(dst_path)
+                continue
+            for subpath in remote_systems[name].get_list():
+                subpath = os.path.normpath(subpath)
+                if os.path.isabs(subpath) or subpath.split(os.sep)[0] == os.pardir:
+                    raise InputValidationError("remote_systems.{}: {} is not a path in the remote_data "
+                                               "directory".format(name, subpath))
+                systems.append(os.path.join(dst_path, subpath))
+        input['training']['systems'] = systems
+
+        # one archive instead of one transport operation per file, unpacked in the job script
+        prepend_text = None
+        if self.inputs.metadata.options.pack_training_data and provenance_exclude_list:
+            _pack_files(folder.abspath, provenance_exclude_list, folder.get_abs_path(self._PACKED_DATA_FILE))
+            for name in sorted({relpath.split(os.sep)[0] for relpath in provenance_exclude_list}):
+                folder.remove_path(name)
+            provenance_exclude_list = [self._PACKED_DATA_FILE]
+            prepend_text = 'tar -xf {0} && rm {0}'.format(self._PACKED_DATA_FILE)
+
         json_str = json.dumps(input, indent=4, sort_keys=False)
 
         with io.open(folder.get_abs_path(self._DEFAULT_INPUT_FILE), mode="w", encoding="utf-8") as fobj:
@@ -94,44 +277,6 @@ class DpCalculation(CalcJob):
             except ValueError as exc:
                 raise InputValidationError("invalid keys or values in input parameters found")
 
-        # Create the subfolder that will contain the train data
-        local_copy_list = []
-        for datadir in self.inputs.datadirs:
-            # change to absolute path
-            if not os.path.exists(datadir):
-                raise FileExistsError("This datadir dose not exist")
-            absdatadir = os.path.abspath(datadir)
-            # create subfolder
-            datadir_basename = os.path.basename(absdatadir)
-            datadir_in_workdir = os.path.join("./", datadir_basename)
-            folder.get_subfolder(datadir_in_workdir, create=True)
-            # this loop use to copy the training data under the datadir
-            for root, directories, files in os.walk(top=absdatadir, topdown=True):
-                relroot = os.path.relpath(root, absdatadir)
-                # create subtree folders
-                for name in directories:
-                    folder.get_subfolder(
-                        os.path.join(
-                            datadir_basename,
-                            relroot,
-                            name),
-                        create=True)
-
-                # give the singlefiledata to file
-                for name in files:
-                    fobj = SinglefileData(
-                        file=os.path.join(root, name)
-                    )
-                    # must save fobj otherwise the node is empty and can't be copied
-                    fobj.store()
-                    dst_path = os.path.join(
-                        datadir_basename,
-                        relroot,
-                        name)
-                    local_copy_list.append((fobj.uuid, fobj.filename, dst_path))
-
-
-
         # settings = self.inputs.settings.get_dict() if 'settings' in self.inputs else {}
 
         # set two code info here, once the training finished, the model will freeze then.
@@ -155,7 +300,13 @@ class DpCalculation(CalcJob):
         # create calc info
         calcinfo = CalcInfo()
         calcinfo.uuid = self.uuid
-        calcinfo.local_copy_list = local_copy_list
+        calcinfo.local_copy_list = []
+        if self.inputs.metadata.options.symlink_remote_data:
+            calcinfo.remote_symlink_list = remote_list
+        else:
+            calcinfo.remote_copy_list = remote_list
+        calcinfo.provenance_exclude_list = provenance_exclude_list
+        calcinfo.prepend_text = prepend_text
         calcinfo.codes_info = [codeinfotrain, codeinfofreeze]
 
         calcinfo.retrieve_list = [
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Calculation functions operating on StructureSet nodes."""
+
+from __future__ import absolute_import
+
+from aiida.engine import calcfunction
+
+
+@calcfunction
+def get_structure_subset(structure_set, indices):
+    """
+    Return the subset of the structures at ``indices``.
+
+    :param structure_set: the StructureSet.
+    :param indices: a List of the indices of the structures.
+    """
+    return structure_set.subset(indices.get_list(), store_provenance=False)
+
+
+@calcfunction
+def split_structure_set(structure_set, fractions, seed):
+    """
+    Split the structures randomly into subsets, e.g. for training and validation.
+
+    :param structure_set: the StructureSet.
+    :param fractions: a List of the fractions of the structures in each subset.
+    :param seed: an Int, the seed of the random permutation.
+    :return: the subsets as ``subset_0``, ``subset_1``, ...
+    """
+    subsets = structure_set.split(fractions.get_list(), seed.value, store_provenance=False)
+    return {'subset_{}'.format(i): subset for i, subset in enumerate(subsets)}
+
+
+@calcfunction
+def merge_structure_sets(**structure_sets):
+    """
+    Merge StructureSet nodes into one, in the order of the sorted input labels.
+
+    Use :py:meth:`~aiida_deepmd.data.structure_set.StructureSet.merge` to
+    merge sets given positionally.
+
+    :param structure_sets: the StructureSet nodes.
+    """
+    from aiida_deepmd.data.structure_set import StructureSet
+
+    return StructureSet.merge(*[structure_sets[key] for key in sorted(structure_sets)], store_provenance=False)
@@ -9,6 +9,488 @@ from __future__ import absolute_import
 
 from aiida.orm import ArrayData
 
+
+def _get_elements(atomic_numbers):
+    """
+    Return the sorted list of chemical symbols present in an array of atomic numbers.
+    """
+    import numpy
+    from ase.data import chemical_symbols
+
+    # a bincount instead of numpy.unique, which would sort a copy of the array
+    return [chemical_symbols[z] for z in numpy.flatnonzero(numpy.bincount(atomic_numbers))]
+
+
+def _to_ase(structure):
+    """
+    Return the structure as ``ase.atoms.Atoms``.
+
+    :raises ValueError: if the structure is not ``ase.atoms.Atoms`` or StructureData.
+    """
+    from ase.atoms import Atoms
+    from aiida.orm import StructureData
+
+    if isinstance(structure, Atoms):
+        return structure
+    elif isinstance(structure, StructureData):
+        return structure.get_ase()
+    else:
+        raise ValueError('structure must be ase.atoms.Atoms or StructureData')
+
+
+def _get_raws(structurelist):
+    """
+    Return the cells, positions, atomic numbers and number of atoms of a list of ``ase.atoms.Atoms``.
+    """
+    import numpy
+
+    cells = numpy.stack([numpy.asarray(x.cell) for x in structurelist])
+    positions = numpy.concatenate([x.arrays['positions'] for x in structurelist])
+    atomic_numbers = numpy.concatenate([x.arrays['numbers'] for x in structurelist])
+    size = numpy.array([len(x) for x in structurelist], dtype=numpy.int64)
+    return cells, positions, atomic_numbers, size
+
+
+def _get_type_lookup(elements):
+    """
+    Return an array mapping atomic numbers to the index of the element in ``elements``.
+    """
+    import numpy
+    from ase.data import atomic_numbers as symbol_to_number
+
+    numbers = [symbol_to_number[e] for e in elements]
+    lookup = numpy.full(max(numbers) + 1, -1, dtype=numpy.int64)
+    lookup[numbers] = numpy.arange(len(numbers))
+    return lookup
+
+
+def _as_float(array):
+    """
+    Return an arrayable as an array, integer and boolean values being cast
+    to float. Float arrays, e.g. memory-mapped or float32, are returned as
+    they are, and other kinds are left for the dtype checks to reject.
+    """
+    import numpy
+
+    array = numpy.asarray(array)
+    if array.dtype.kind in 'biu':
+        return array.astype(float)
+    return array
+
+
+def _as_forces(forces):
+    """
+    Return the forces as an array of shape (Natoms, 3), from an arrayable or a list of per-structure forces.
+    """
+    import numpy
+
+    if isinstance(forces, (list, tuple)):
+        forces = numpy.concatenate([numpy.reshape(x, [-1, 3]) for x in forces])
+    return _as_float(forces).reshape([-1, 3])
+
+
+def _format_indices(indices, limit=10):
+    """
+    Return a short string listing the indices, truncated after ``limit`` of them.
+    """
+    string = ', '.join(str(i) for i in indices[:limit])
+    if len(indices) > limit:
+        string += ', ... ({} in total)'.format(len(indices))
+    return string
+
+
+def _check_array(name, array, shape, kinds):
+    """
+    Check the shape and the dtype of an array.
+
+    :param shape: the expected shape, None for the dimensions of any length.
+    :param kinds: the allowed ``numpy.dtype.kind`` characters.
+    :raises ValueError: if the shape or the dtype is not the expected one.
+    """
+    if array.ndim != len(shape) or any(n is not None and n != m for n, m in zip(shape, array.shape)):
+        raise ValueError('{} has shape {}, expected ({})'.format(
+            name, array.shape, ', '.join('*' if n is None else str(n) for n in shape)))
+    if array.dtype.kind not in kinds:
+        raise ValueError('{} has dtype {}'.format(name, array.dtype))
+
+
+def _check_finite(name, array, offsets=None):
+    """
+    Check that all the values of an array are finite.
+
+    :param offsets: the offsets of the structures if the rows of the array are atoms.
+    :raises ValueError: naming the structures with non finite values.
+    """
+    import numpy
+
+    finite = numpy.isfinite(array)
+    if finite.all():
+        return
+
+    rows = numpy.flatnonzero(~finite.reshape([len(array), -1]).all(axis=1))
+    if offsets is not None:
+        rows = numpy.unique(numpy.searchsorted(offsets, rows, side='right') - 1)
+    raise ValueError('{} has non finite values for the structures {}'.format(name, _format_indices(rows)))
+
+
+def _validate_labels(offsets, energies=None, forces=None, virials=None):
+    """
+    Validate the labels of the structures given by ``offsets``.
+
+    :raises ValueError: if the shape or dtype of a label is wrong, or a value is not finite.
+    """
+    length, natoms = len(offsets) - 1, offsets[-1]
+    if energies is not None:
+        _check_array('energies', energies, (length,), 'f')
+        _check_finite('energies', energies)
+    if forces is not None:
+        _check_array('forces', forces, (natoms, 3), 'f')
+        _check_finite('forces', forces, offsets)
+    if virials is not None:
+        _check_array('virials', virials, (length, 3, 3), 'f')
+        _check_finite('virials', virials)
+
+
+def _has_close_contact(positions, cell, rmin):
+    """
+    Return True if two atoms of a periodic structure, or an atom and one of
+    its images, are closer than ``rmin``.
+
+    The atoms are sorted into a cell list of bins at least ``rmin`` wide, so
+    only the pairs in neighbouring bins are compared. Cells thinner than
+    three bins are checked against all the periodic images instead.
+    """
+    import itertools
+    import numpy
+
+    inverse = numpy.linalg.inv(cell)
+    scaled = numpy.dot(positions, inverse) % 1.
+    # the distances between the opposite faces of the cell
+    widths = 1. / numpy.linalg.norm(inverse, axis=0)
+    nbins = numpy.floor(widths / rmin).astype(int)
+
+    if (nbins < 3).any():
+        ranges = [range(-m, m + 1) for m in numpy.ceil(rmin / widths).astype(int) + 1]
+        shifts = numpy.dot(numpy.array(list(itertools.product(*ranges))), cell)
+        wrapped = numpy.dot(scaled, cell)
+        vectors = wrapped[None, :, None, :] - wrapped[:, None, None, :] + shifts
+        distances = (vectors**2).sum(axis=-1)
+        # an atom is not in contact with itself
+        distances[numpy.arange(len(positions)), numpy.arange(len(positions)), len(shifts) // 2] = numpy.inf
+        return bool((distances < rmin**2).any())
+
+    bins = numpy.minimum((scaled * nbins).astype(int), nbins - 1)
+    order = numpy.argsort(numpy.ravel_multi_index(bins.T, nbins), kind='stable')
+    bin_starts = numpy.searchsorted(numpy.ravel_multi_index(bins[order].T, nbins), numpy.arange(nbins.prod() + 1))
+
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        neighbours = numpy.ravel_multi_index(((bins + offset) % nbins).T, nbins)
+        starts, counts = bin_starts[neighbours], bin_starts[neighbours + 1] - bin_starts[neighbours]
+        first = numpy.repeat(numpy.arange(len(positions)), counts)
+        second = order[numpy.repeat(starts - (numpy.cumsum(counts) - counts), counts) + numpy.arange(counts.sum())]
+
+        # each pair is met from both of its atoms, keep it once
+        keep = first < second
+        vectors = scaled[second[keep]] - scaled[first[keep]]
+        vectors -= numpy.rint(vectors)
+        if ((numpy.dot(vectors, cell)**2).sum(axis=1) < rmin**2).any():
+            return True
+
+    return False
+
+
+def _count_elements(atomic_numbers, offsets, elements, chunk_size=100000):
+    """
+    Return the number of atoms of each element in each structure.
+
+    :param atomic_numbers: the atomic numbers of all atoms, possibly memory-mapped.
+    :param offsets: the offsets of the structures, length N+1.
+    :param elements: the chemical symbols of the columns.
+    :return: int array of shape (N, len(elements)).
+    """
+    import numpy
+
+    lookup = _get_type_lookup(elements)
+    length = len(offsets) - 1
+    ntypes = len(elements)
+    counts = numpy.zeros([length, ntypes], dtype=numpy.int64)
+    for start in range(0, length, chunk_size):
+        end = min(start + chunk_size, length)
+        types = lookup[atomic_numbers[offsets[start]:offsets[end]]]
+        structure_ids = numpy.repeat(numpy.arange(end - start), numpy.diff(offsets[start:end + 1]))
+        counts[start:end] = numpy.bincount(structure_ids * ntypes + types,
+                                           minlength=(end - start) * ntypes).reshape([-1, ntypes])
+    return counts
+
+
+def _describe(values, groups=None):
+    """
+    Return the min, max, mean and std of ``values``, or of each group of values.
+
+    :param groups: the group of each value, the groups being 0, 1, ... if not None.
+    :return: a dict, or a list of dicts indexed by group.
+    """
+    import numpy
+
+    if groups is None:
+        return {
+            'min': float(values.min()),
+            'max': float(values.max()),
+            'mean': float(values.mean()),
+            'std': float(values.std()),
+        }
+
+    order = numpy.argsort(groups, kind='stable')
+    number = numpy.bincount(groups)
+    starts = numpy.concatenate([[0], numpy.cumsum(number)[:-1]])
+    mean = numpy.bincount(groups, weights=values) / number
+    std = numpy.sqrt(numpy.maximum(numpy.bincount(groups, weights=values**2) / number - mean**2, 0.))
+    minimum = numpy.minimum.reduceat(values[order], starts)
+    maximum = numpy.maximum.reduceat(values[order], starts)
+    return [{
+        'min': float(a),
+        'max': float(b),
+        'mean': float(c),
+        'std': float(d)
+    } for a, b, c, d in zip(minimum, maximum, mean, std)]
+
+
+def _stress_to_virial(stress, cell):
+    """
+    Return the virial, shape (3, 3), of a stress in the Voigt (6,) or full (3, 3) form.
+    """
+    import numpy
+    from ase.stress import voigt_6_to_full_3x3_stress
+
+    stress = numpy.asarray(stress, dtype=float)
+    if stress.shape == (6,):
+        stress = voigt_6_to_full_3x3_stress(stress)
+    return -stress.reshape([3, 3]) * abs(numpy.linalg.det(cell))
+
+
+def _virial_to_stress(virial, cell):
+    """
+    Return the stress in the Voigt form of a virial, shape (3, 3).
+    """
+    import numpy
+    from ase.stress import full_3x3_to_voigt_6_stress
+
+    return full_3x3_to_voigt_6_stress(-numpy.asarray(virial, dtype=float) / abs(numpy.linalg.det(cell)))
+
+
+def _parse_extxyz_comment(comment):
+    """
+    Return the ``key=value`` and ``key="value"`` pairs of the comment line of an extended XYZ frame.
+    """
+    import re
+
+    return {key: quoted or value for key, quoted, value in re.findall(r'(\S+?)=(?:"([^"]*)"|(\S*))', comment)}
+
+
+def _parse_extxyz_frames(frames):
+    """
+    Parse frames of an extended XYZ file.
+
+    The frames are parsed by runs of consecutive frames with the same
+    ``Properties``, e.g. with or without forces, each run giving a chunk
+    whose labels are then intersected by ``StructureSet._from_chunks``.
+
+    :param frames: a list of (comment line, atom lines) of the frames.
+    :return: a list of dicts of the arrays of the runs of frames, see ``StructureSet._from_chunks``.
+    :raises ValueError: if a frame has no Lattice, no positions or no species.
+    """
+    infos = [_parse_extxyz_comment(comment) for comment, _ in frames]
+    properties = [info.get('Properties', 'species:S:1:pos:R:3') for info in infos]
+    starts = [i for i in range(len(frames)) if i == 0 or properties[i] != properties[i - 1]] + [len(frames)]
+    return [
+        _parse_extxyz_run(frames[start:end], infos[start:end], properties[start])
+        for start, end in zip(starts[:-1], starts[1:])
+    ]
+
+
+def _parse_extxyz_run(frames, infos, properties):
+    """
+    Parse frames of an extended XYZ file with the same ``Properties``.
+
+    :param frames: a list of (comment line, atom lines) of the frames.
+    :param infos: the key-value pairs of the comment lines of the frames.
+    :param properties: the ``Properties`` of the frames.
+    :return: a dict of the arrays of the frames, see ``StructureSet._from_chunks``.
+    :raises ValueError: if a frame has no Lattice, no positions or no species,
+        or if an atom line has not the columns of the properties.
+    """
+    import numpy
+    from ase.data import atomic_numbers as symbol_to_number
+
+    if not all('Lattice' in info for info in infos):
+        raise ValueError('the frames must have a Lattice')
+
+    # the first column and the number of columns of each property, e.g. {'species': (0, 1), 'pos': (1, 3)}
+    columns = {}
+    fields = properties.split(':')
+    ncolumns = 0
+    for name, width in zip(fields[::3], fields[2::3]):
+        columns[name] = (ncolumns, int(width))
+        ncolumns += int(width)
+    if 'pos' not in columns or not {'species', 'Z'} & set(columns):
+        raise ValueError('the frames must have the pos and species (or Z) properties')
+
+    # one list of all the tokens, each column being converted from a strided slice
+    tokens = ' '.join(line for _, lines in frames for line in lines).split()
+    if len(tokens) != ncolumns * sum(len(lines) for _, lines in frames):
+        raise ValueError('the atom lines must have the {} columns of the Properties {}'.format(ncolumns, properties))
+
+    def column(name, dtype=float):
+        first, width = columns[name]
+        return numpy.stack([numpy.array(tokens[first + i::ncolumns], dtype=dtype) for i in range(width)], axis=1)
+
+    if 'Z' in columns:
+        atomic_numbers = column('Z', numpy.int64).reshape([-1])
+    else:
+        symbols = tokens[columns['species'][0]::ncolumns]
+        lookup = {x: symbol_to_number[x] for x in set(symbols)}
+        atomic_numbers = numpy.array([lookup[x] for x in symbols], dtype=numpy.int64)
+
+    def matrices(key):
+        return numpy.array([info[key].split() for info in infos], dtype=float)
+
+    cells = matrices('Lattice').reshape([-1, 3, 3])
+    arrays = {
+        'cells': cells,
+        'positions': column('pos'),
+        'atomic_numbers': atomic_numbers,
+        'size': numpy.array([len(lines) for _, lines in frames], dtype=numpy.int64),
+    }
+    if all('energy' in info for info in infos):
+        arrays['energies'] = numpy.array([info['energy'] for info in infos], dtype=float)
+    for name in ('forces', 'force'):
+        if name in columns:
+            arrays['forces'] = column(name)
+            break
+    if all('virial' in info for info in infos):
+        arrays['virials'] = matrices('virial').reshape([-1, 3, 3])
+    elif all('stress' in info for info in infos):
+        arrays['virials'] = numpy.array([_stress_to_virial(x, cell) for x, cell in zip(matrices('stress'), cells)])
+    return arrays
+
+
+def _get_norm_percentiles(vectors, offsets, percentiles, chunk_size=100000, nbins=2**16):
+    """
+    Return the maximum and the percentiles of the norms of per-atom vectors.
+
+    The norms are computed ``chunk_size`` structures at a time, possibly
+    from a memory-mapped array, and binned in ``nbins`` bins up to the
+    maximum, so the memory needed is bounded by the chunk size. The
+    percentiles are the centres of their bins, exact to half a bin width.
+
+    :param vectors: float array of shape (Natoms, 3), e.g. the forces.
+    :param offsets: the offsets of the structures, length N+1.
+    :param percentiles: the percentiles, between 0 and 100.
+    :return: the maximum, and the list of the percentiles.
+    """
+    import numpy
+
+    length = len(offsets) - 1
+
+    def iter_norms():
+        for start in range(0, length, chunk_size):
+            end = min(start + chunk_size, length)
+            chunk = numpy.asarray(vectors[offsets[start]:offsets[end]], dtype=float)
+            yield numpy.sqrt(numpy.einsum('ij,ij->i', chunk, chunk))
+
+    maximum = max(float(norms.max()) for norms in iter_norms())
+    if maximum == 0.:
+        return maximum, [0.] * len(percentiles)
+
+    counts = numpy.zeros([nbins], dtype=numpy.int64)
+    for norms in iter_norms():
+        bins = numpy.minimum((norms * (nbins / maximum)).astype(numpy.int64), nbins - 1)
+        counts += numpy.bincount(bins, minlength=nbins)
+    # interpolate between the sorted norms around each rank, as numpy.percentile
+    ranks = numpy.asarray(percentiles, dtype=float) / 100. * (offsets[-1] - 1)
+    cumulative = numpy.cumsum(counts)
+    lower = (numpy.searchsorted(cumulative, numpy.floor(ranks), side='right') + 0.5) * (maximum / nbins)
+    upper = (numpy.searchsorted(cumulative, numpy.ceil(ranks), side='right') + 0.5) * (maximum / nbins)
+    return maximum, (lower + (ranks - numpy.floor(ranks)) * (upper - lower)).tolist()
+
+
+def _get_formula(elements, counts):
+    """
+    Return the chemical formula in Hill notation, same as ``ase.atoms.Atoms.get_chemical_formula()``.
+    """
+    counts = {e: int(n) for e, n in zip(elements, counts) if n}
+    if 'C' in counts:
+        order = ['C'] + (['H'] if 'H' in counts else []) + sorted(set(counts) - {'C', 'H'})
+    else:
+        order = sorted(counts)
+    return ''.join(e if counts[e] == 1 else '{}{}'.format(e, counts[e]) for e in order)
+
+
+class StructureView(object):
+    """
+    A lightweight view of a structure of a StructureSet, as returned by
+    indexing the set. The arrays of the structure are sliced on access from
+    the decoded arrays cached by the set.
+    """
+    __slots__ = ('structure_set', 'index')
+
+    def __init__(self, structure_set, index):
+        self.structure_set = structure_set
+        self.index = index
+
+    def __len__(self):
+        return self.structure_set.size[self.index]
+
+    def __repr__(self):
+        return '<StructureView: {}[{}] {}>'.format(self.structure_set.__class__.__name__, self.index,
+                                                   self.structure_set.get_formulas()[self.index])
+
+    def _atoms(self):
+        offsets = self.structure_set.get_offsets()
+        return slice(offsets[self.index], offsets[self.index + 1])
+
+    @property
+    def cell(self):
+        return self.structure_set.get_cells()[self.index]
+
+    @property
+    def positions(self):
+        return self.structure_set.get_positions()[self._atoms()]
+
+    @property
+    def numbers(self):
+        return self.structure_set.get_atomic_numbers()[self._atoms()]
+
+    @property
+    def energy(self):
+        energies = self.structure_set.get_energies()
+        return None if energies is None else energies[self.index]
+
+    @property
+    def forces(self):
+        return self.structure_set.get_forces(self.index)
+
+    @property
+    def virial(self):
+        return self.structure_set.get_virials(self.index)
+
+    def get_ase(self):
+        """
+        Return the structure as ``ase.atoms.Atoms``.
+        """
+        from ase.atoms import Atoms
+
+        return Atoms(cell=self.cell, positions=self.positions, numbers=self.numbers, pbc=True)
+
+    def get_structure(self):
+        """
+        Return the structure as StructureData.
+        """
+        from aiida.orm import StructureData
+
+        return StructureData(ase=self.get_ase())
+
+
 class StructureSet(ArrayData):
     """
     StructureSet stores a collection of structures and stores
@@ -20,101 +502,356 @@ class StructureSet(ArrayData):
     The class is similar to the TrajectoryData in aiida_core and some
     of methods are same.
     """
-    def __init__(self, structurelist=None, **kwargs):
+    # arrays of the legacy frame layout, see `migrate`
+    _FRAME_LAYOUT_ARRAYS = ('nframes', 'cnframes')
+
+    # default bound of the memory used by the cache of decoded arrays, see `set_cache_size`
+    _CACHE_MAX_BYTES = 512 * 1024**2
+
+    # arrays stored with a smaller dtype under the reduced precision storage, see `set_storage`
+    _REDUCED_DTYPES = {'positions': 'float32', 'forces': 'float32', 'atomic_numbers': 'int8'}
+
+    def __init__(self, structurelist=None, reduced_precision=False, compress=False, **kwargs):
         super(StructureSet, self).__init__(**kwargs)
+        if reduced_precision or compress:
+            self.set_storage(reduced_precision=reduced_precision, compress=compress)
         if structurelist is not None:
             self.set_structurelist(structurelist)
 
-    def _internal_validate(self, nframes, cells, positions, atomic_numbers, ids, energies):
+    def __len__(self):
+        return self.get_attribute('length', 0)
+
+    def __bool__(self):
+        # a node is true even if it holds no structure
+        return True
+
+    __nonzero__ = __bool__
+
+    def __getitem__(self, key):
+        """
+        Return the StructureView of a structure, or a list of them for a slice.
+        """
+        import operator
+
+        if isinstance(key, slice):
+            return [StructureView(self, idx) for idx in range(*key.indices(len(self)))]
+
+        idx = operator.index(key)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('structure index out of range')
+        return StructureView(self, idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield StructureView(self, idx)
+
+    def initialize(self):
+        """
+        Initialize the cache of decoded arrays, for new and loaded nodes alike.
+        """
+        from collections import OrderedDict
+
+        super(StructureSet, self).initialize()
+        self._array_cache = OrderedDict()
+        self._cache_nbytes = 0
+        self._cache_max_bytes = self._CACHE_MAX_BYTES
+
+    def set_cache_size(self, max_bytes):
+        """
+        Set the bound of the memory used by the cache of decoded arrays.
+
+        The arrays read by :py:meth:`get_array` are kept in memory, the least
+        recently used ones being evicted once the bound is exceeded. Arrays
+        larger than the bound are not cached.
+
+        :param max_bytes: the maximum number of bytes, 0 to disable the cache.
+        """
+        self._cache_max_bytes = max_bytes
+        self._evict_arrays()
+
+    def _cache_array(self, name, array):
+        """
+        Add a decoded array to the cache as read-only, if it fits.
+        """
+        if array.nbytes > self._cache_max_bytes:
+            return
+        array.flags.writeable = False
+        self._uncache_array(name)
+        self._array_cache[name] = array
+        self._cache_nbytes += array.nbytes
+        self._evict_arrays()
+
+    def _uncache_array(self, name):
+        """
+        Remove an array from the cache, if it is there.
+        """
+        array = self._array_cache.pop(name, None)
+        if array is not None:
+            self._cache_nbytes -= array.nbytes
+
+    def _evict_arrays(self):
+        """
+        Evict the least recently used arrays until the cache fits its bound.
+        """
+        while self._array_cache and self._cache_nbytes > self._cache_max_bytes:
+            _, array = self._array_cache.popitem(last=False)
+            self._cache_nbytes -= array.nbytes
+
+    def set_storage(self, reduced_precision=False, compress=False):
+        """
+        Set how the arrays of the node are stored.
+
+        The arrays already set are stored again with the new policy. The
+        getters return the arrays with the stored dtype.
+
+        :param reduced_precision: store ``positions`` and ``forces`` as
+            float32 and ``atomic_numbers`` as int8. Cells, energies and
+            virials keep their precision.
+        :param compress: store the arrays as compressed .npz files. They can
+            then not be memory-mapped and are loaded in full.
+        """
+        arrays = {name: self.get_array(name) for name in self.get_arraynames()}
+        self.set_attribute('storage', {'reduced_precision': reduced_precision, 'compress': compress})
+        for name, array in arrays.items():
+            self.set_array(name, array)
+
+    def set_array(self, name, array):
+        """
+        Store an array, following the storage policy set with :py:meth:`set_storage`.
+
+        :param name: the name of the array.
+        :param array: the numpy array.
+        """
+        import tempfile
+        import numpy
+
+        self._uncache_array(name)
+
+        storage = self.get_attribute('storage', {})
+        if storage.get('reduced_precision') and name in self._REDUCED_DTYPES:
+            array = array.astype(self._REDUCED_DTYPES[name])
+
+        npz_filename = '{}.npz'.format(name)
+        if not storage.get('compress'):
+            if npz_filename in self.list_object_names():
+                self.delete_object(npz_filename)
+            return super(StructureSet, self).set_array(name, array)
+
+        if '{}.npy'.format(name) in self.list_object_names():
+            self.delete_object('{}.npy'.format(name))
+        with tempfile.NamedTemporaryFile() as handle:
+            numpy.savez_compressed(handle, array)
+            handle.flush()
+            handle.seek(0)
+            self.put_object_from_filelike(handle, npz_filename, mode='wb', encoding=None)
+        self.set_attribute('{}{}'.format(self.array_prefix, name), list(array.shape))
+
+    def _arraynames_from_files(self):
+        """
+        Return the names of the arrays stored as files, the compressed .npz
+        files included, so that ``ArrayData._validate`` matches them with
+        the array attributes when the node is stored.
+        """
+        compressed = [name[:-4] for name in self.list_object_names() if name.endswith('.npz')]
+        return super(StructureSet, self)._arraynames_from_files() + compressed
+
+    def delete_array(self, name):
+        """
+        Delete an array from the node, whether it is compressed or not.
+
+        :param name: the name of the array.
+        """
+        self._uncache_array(name)
+
+        npz_filename = '{}.npz'.format(name)
+        if npz_filename in self.list_object_names():
+            self.delete_object(npz_filename)
+            self.delete_attribute('{}{}'.format(self.array_prefix, name))
+        else:
+            super(StructureSet, self).delete_array(name)
+
+    def _internal_validate(self, cells, positions, atomic_numbers, offsets, ids, energies, forces, virials, pks=None):
         """
         To validate the type and shape of the array.
+
+        Each check is a vectorized pass over an array: shapes and dtypes,
+        consistency of the offsets, finite values, atomic numbers, non
+        singular cells and the length of the labels.
+
+        :raises ValueError: with the indices of the offending structures.
         """
-        pass
+        import numpy
+
+        _check_array('offsets', offsets, (None,), 'iu')
+        if len(offsets) < 2 or offsets[0] != 0:
+            raise ValueError('offsets must start with 0 and describe at least one structure')
+        empty = numpy.flatnonzero(numpy.diff(offsets) <= 0)
+        if len(empty):
+            raise ValueError('offsets give no atoms to the structures {}'.format(_format_indices(empty)))
+
+        length, natoms = len(offsets) - 1, offsets[-1]
+        _check_array('cells', cells, (length, 3, 3), 'f')
+        _check_array('positions', positions, (natoms, 3), 'f')
+        _check_array('atomic_numbers', atomic_numbers, (natoms,), 'iu')
+        if ids is not None:
+            _check_array('ids', ids, (length,), 'iu')
+        if pks is not None:
+            _check_array('pks', pks, (length,), 'iu')
+
+        _check_finite('cells', cells)
+        _check_finite('positions', positions, offsets)
+
+        if atomic_numbers.min() < 1 or atomic_numbers.max() > 118:
+            invalid = numpy.flatnonzero((atomic_numbers < 1) | (atomic_numbers > 118))
+            invalid = numpy.unique(numpy.searchsorted(offsets, invalid, side='right') - 1)
+            raise ValueError('atomic_numbers are invalid for the structures {}'.format(_format_indices(invalid)))
+
+        # the volume as a triple product, several times faster than numpy.linalg.det
+        volumes = numpy.einsum('ki,ki->k', cells[:, 0], numpy.cross(cells[:, 1], cells[:, 2]))
+        singular = numpy.flatnonzero(numpy.abs(volumes) < 1e-6)
+        if len(singular):
+            raise ValueError('cells are singular for the structures {}'.format(_format_indices(singular)))
+
+        _validate_labels(offsets, energies, forces, virials)
 
-    def set_collection(self, elements, nframes, frame_size, cells, positions, atomic_numbers, ids=None, energies=None):
+    def set_collection(self, cells, positions, atomic_numbers, offsets, ids=None, energies=None, forces=None,
+                       virials=None, pks=None):
         r"""
-        Store the collection, afteStructureSet.from_raws(cells, positions, atomic_numbers, nframes)r checking that types and dimensions
+        Store the collection, after checking that types and dimensions
         are correct.
 
         This is the main method to initialize the object, all the arrays
         are set in this method.
 
-        Parameters ``ids`` and ``energies`` are optional variables. If
+        The atoms of all the structures are stored contiguously in
+        ``positions`` and ``atomic_numbers``, the atoms of the i-th
+        structure being the rows ``offsets[i]:offsets[i+1]``.
+
+        Parameters ``ids`` and the labels ``energies``, ``forces`` and
+        ``virials`` are optional variables. If
         no input is given for ``ids`` a consecutive sequence
-        [0,1,2,...,len(nframes)-1] will be assumed.
+        [0,1,2,...,len(offsets)-2] will be assumed.
+
+        :param cells: float array, shape (N, 3, 3), the cells of the structures.
 
-        :param nframes: number of frames needed to represent a structure.
-                        An 1D int array, length N, which store the number
-                        of frames needed to represent a structure.
-                        As for primitive the number is 1, as for x times
-                        volume supercell the number of frames is x.
+        :param positions: float array, shape (Natoms, 3), the positions of
+                        the atoms of all structures.
 
-        :param cells:
+        :param atomic_numbers: int array, shape (Natoms,).
 
-        :param positions:
+        :param offsets: int array, length N+1, starting with 0 and ending
+                        with Natoms. The number of atoms of the structures
+                        is ``numpy.diff(offsets)``.
 
-        :param atomic_numbers:
+        :param ids: int array, length N.
 
-        :param ids:
+        :param energies: float array, length N.
 
-        :param energies:
+        :param forces: float array, shape (Natoms, 3), aligned with ``positions``.
 
-        :(hide) param cnframes: deduced from nframes,
-                        integral of number of frames. Initialized in the method.
-                        An 1D int array, length N. Combined with number_of_frames,
-                        user can easily index the location and extract the info of
-                        the structures stored in this type.
+        :param virials: float array, shape (N, 3, 3).
 
+        :param pks: int array, length N, the pks of the StructureData nodes
+                    the structures come from, stored as ``pks`` if given.
         """
 
         import numpy
 
-        self._internal_validate(nframes, cells, positions, atomic_numbers, ids, energies)
+        cells = _as_float(cells)
+        positions = _as_float(positions)
+        atomic_numbers = numpy.asarray(atomic_numbers)
+        offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        ids = None if ids is None else numpy.asarray(ids)
+        energies = None if energies is None else _as_float(energies)
+        forces = None if forces is None else _as_forces(forces)
+        virials = None if virials is None else _as_float(virials).reshape([-1, 3, 3])
+        pks = None if pks is None else numpy.asarray(pks)
+        self._internal_validate(cells, positions, atomic_numbers, offsets, ids, energies, forces, virials, pks)
 
         # set attribute for easier query
 
         # length is the number of structurs
         # size is a list of atom numbers of each structures
-        self.set_attribute('length', len(nframes))
-        size = nframes * frame_size
-        self.set_attribute('size', size.tolist())
+        self.set_attribute('length', len(offsets) - 1)
+        self.set_attribute('size', numpy.diff(offsets).tolist())
 
+        elements = _get_elements(atomic_numbers)
         self.set_attribute('elements', elements)
+        self._set_composition_index(elements, _count_elements(atomic_numbers, offsets, elements))
+
+        # drop the arrays of the frame layout if the node is being rewritten
+        for name in self._FRAME_LAYOUT_ARRAYS:
+            if name in self.get_arraynames():
+                self.delete_array(name)
 
         # set arrays
         self.set_array('cells', cells)
         self.set_array('positions', positions)
         self.set_array('atomic_numbers', atomic_numbers)
-
-        self.set_array('nframes', nframes)
-        cnframes = numpy.cumsum(nframes) - nframes
-        self.set_array('cnframes', cnframes)
+        self.set_array('offsets', offsets)
 
         if energies is not None:
             self.set_array('energies', energies)
+        if forces is not None:
+            self.set_array('forces', forces)
+        if virials is not None:
+            self.set_array('virials', virials)
 
         if ids is not None:
             self.set_array('indices', ids)
         else:  # use consecutive sequence if not given
-            self.set_array('indices', numpy.arange(len(nframes)))
+            self.set_array('indices', numpy.arange(len(offsets) - 1))
+        if pks is not None:
+            self.set_array('pks', pks)
+        elif 'pks' in self.get_arraynames():
+            self.delete_array('pks')
 
-    def from_raws(self, cells, positions, atomic_numbers, nframes):
+        self.set_attribute('statistics', {})
+        self._set_statistics(offsets, energies=energies, forces=forces, virials=virials)
+
+    def from_raws(self, cells, positions, atomic_numbers, size):
         """
         A simple cell of set_collection
 
         All param is two dimensional array needed to reshape.
-        :param:
+
+        :param size: the number of atoms of each structure.
+        """
+        import numpy
+
+        size = numpy.asarray(size, dtype=numpy.int64)
+        offsets = numpy.concatenate([[0], numpy.cumsum(size)])
+
+        cells = numpy.asarray(cells).reshape([len(size), 3, 3])
+        positions = numpy.asarray(positions).reshape([-1, 3])
+        atomic_numbers = numpy.asarray(atomic_numbers).reshape([-1])
+        return self.set_collection(cells, positions, atomic_numbers, offsets)
+
+    def migrate(self):
         """
-        number_of_structures = len(nframes)
-        number_of_frames = int(sum(nframes))
-        frame_size = int(len(atomic_numbers) / number_of_frames)
-        elements = set(atomic_numbers)
+        Return a copy of the node in the offset layout.
+
+        Nodes created before the offset layout store the atoms in frames of
+        ``frame_size`` atoms, ``positions`` having shape (Nframes, frame_size, 3)
+        and the ``nframes``/``cnframes`` arrays giving the frames of each
+        structure. Such nodes are still readable, this method converts them
+        so that they can be stored without the frame bookkeeping.
 
-        cells = cells.reshape([number_of_structures, 3, 3])
-        positions = positions.reshape([number_of_frames, frame_size, 3])
-        atomic_numbers = atomic_numbers.reshape([number_of_frames, frame_size])
-        return self.set_collection(elements, nframes, frame_size, cells, positions, atomic_numbers)
+        :return: a new, unstored StructureSet.
+        """
+        migrated = StructureSet()
+        migrated.set_collection(self.get_cells(), self.get_positions(), self.get_atomic_numbers(), self.get_offsets(),
+                                ids=self.get_array('indices'), energies=self.get_energies(),
+                                forces=self.get_forces(), virials=self.get_virials(), pks=self.get_pks())
+        return migrated
 
+    def _is_frame_layout(self):
+        """
+        Return True if the node uses the legacy frame layout, see :py:meth:`migrate`.
+        """
+        return 'nframes' in self.get_arraynames()
 
     @property
     def size(self):
@@ -124,6 +861,35 @@ class StructureSet(ArrayData):
     def length(self):
         return self.get_attribute('length')
 
+    def get_elements(self):
+        """
+        Return the chemical symbols of the elements of the set, the
+        ``elements`` attribute or, for nodes stored without it in the
+        legacy frame layout, the elements of the atomic numbers.
+        """
+        elements = self.get_attribute('elements', None)
+        if elements is None:
+            elements = _get_elements(self.get_atomic_numbers(mmap=True))
+        return elements
+
+    def get_formulas(self):
+        """
+        Return the formula of each structure in Hill notation, looked up
+        from the ``formulas`` attribute and the ``formula_indices`` array or,
+        for nodes stored without them in the legacy frame layout, computed
+        from the atomic numbers.
+        """
+        import numpy
+
+        if 'formula_indices' in self.get_arraynames():
+            unique_formulas = self.get_attribute('formulas')
+            inverse = self.get_array('formula_indices')
+        else:
+            elements = self.get_elements()
+            unique_counts, inverse = numpy.unique(self._get_element_counts(), axis=0, return_inverse=True)
+            unique_formulas = [_get_formula(elements, x) for x in unique_counts]
+        return [unique_formulas[i] for i in inverse.reshape([-1])]
+
     def set_structurelist(self, structurelist):
         """
         Create collection from the list of
@@ -136,110 +902,1294 @@ class StructureSet(ArrayData):
             invalid
         """
         import numpy
-        from math import gcd
-        from functools import reduce
-        from ase.atoms import Atoms
-        from aiida.orm import StructureData
 
-        def to_ase(structure):
-            if isinstance(structure, Atoms):
-                return structure
-            elif isinstance(structure, StructureData):
-                return structure.get_ase()
-            else:
-                raise ValueError('structure must be ase.atoms.Atoms or StructureData')
+        structurelist = [_to_ase(x) for x in structurelist]
+        if not structurelist:
+            raise ValueError('structurelist must contain at least one structure')
 
-        structurelist = [to_ase(x) for x in structurelist]
+        cells, positions, atomic_numbers, size = _get_raws(structurelist)
+        offsets = numpy.concatenate([[0], numpy.cumsum(size)])
+        self.set_collection(cells=cells, positions=positions, atomic_numbers=atomic_numbers, offsets=offsets)
 
-        arr_cells = numpy.array([x.cell for x in structurelist])
+    @classmethod
+    def from_structures_query(cls, source, batch_size=1000):
+        """
+        Create a StructureSet from StructureData nodes of the database.
 
-        # the size of a frame is the common greatest divisor of the number of atoms
-        number_of_atoms = [s.get_number_of_atoms() for s in structurelist]
-        frame_size = reduce(gcd, number_of_atoms)
-        nframes = numpy.array([i/frame_size for i in number_of_atoms], dtype=int)
-        cnframes = numpy.cumsum(nframes) - nframes
-        total_frames = sum(nframes)
+        Only the ``cell``, ``sites`` and ``kinds`` attributes of the nodes
+        are projected, in a single query, and converted to arrays without
+        loading any node. The pks of the nodes are stored as the ``pks``
+        array, see :py:meth:`get_pks`.
 
-        arr_positions = numpy.zeros(shape=[total_frames, frame_size, 3])
-        arr_atomic_numbers = numpy.zeros(shape=[total_frames, frame_size], dtype=int)
+        :param source: a Group of StructureData nodes, or a QueryBuilder
+            whose last appended entity is the StructureData nodes.
+        :param batch_size: the number of rows fetched from the database at once.
+        :return: a new, unstored StructureSet.
 
-        ase_structurelist = [s for s in structurelist]
-        elements = set()
-        for i, x in enumerate(ase_structurelist):
-            size_n = nframes[i]
-            start = cnframes[i]
-            elements.update(set(x.get_chemical_symbols()))
+        :raises ValueError: if no structure is found, or if a structure has
+            kinds with several symbols (alloys or vacancies).
+        """
+        import numpy
+        from ase.data import atomic_numbers as symbol_to_number
+        from aiida.orm import Group, QueryBuilder, StructureData
 
-            for j in range(size_n):
-                part_positions = x.arrays['positions'][j*frame_size:(j+1)*frame_size,:]
-                arr_positions[start+j,:,:] = part_positions
+        projections = ['id', 'attributes.cell', 'attributes.sites', 'attributes.kinds']
+        if isinstance(source, Group):
+            query = QueryBuilder()
+            query.append(Group, filters={'id': source.pk}, tag='group')
+            query.append(StructureData, with_group='group', project=projections, tag='structure')
+            query.order_by({'structure': ['id']})
+        else:
+            queryhelp = source.get_json_compatible_queryhelp()
+            queryhelp['project'] = {queryhelp['path'][-1]['tag']: projections}
+            query = QueryBuilder(**queryhelp)
 
-                part_atomic_numbers = x.arrays['numbers'][j*frame_size:(j+1)*frame_size]
-                arr_atomic_numbers[start+j,:] = part_atomic_numbers
+        pks, cells, positions, atomic_numbers, size = [], [], [], [], []
+        for pk, cell, sites, kinds in query.iterall(batch_size=batch_size):
+            numbers = {}
+            for kind in kinds:
+                if len(kind['symbols']) != 1:
+                    raise ValueError('StructureData<{}> has alloy or vacancy kinds'.format(pk))
+                numbers[kind['name']] = symbol_to_number[kind['symbols'][0]]
 
-        self.set_collection(elements=elements, nframes=nframes, frame_size=frame_size, cells=arr_cells, positions=arr_positions, atomic_numbers=arr_atomic_numbers)
+            pks.append(pk)
+            cells.append(cell)
+            positions.extend(site['position'] for site in sites)
+            atomic_numbers.extend(numbers[site['kind_name']] for site in sites)
+            size.append(len(sites))
 
-    def set_energies(self, energies):
-        """
-        :param energies: energies is a arrayable type. list or array.
-        The number of elements of energies should be equal to number of structures.
-        """
-        import numpy
+        if not pks:
+            raise ValueError('no StructureData found')
 
-        self.set_array('energies', numpy.array(energies))
+        structure_set = cls()
+        structure_set.set_collection(numpy.array(cells, dtype=float),
+                                     numpy.array(positions, dtype=float),
+                                     numpy.array(atomic_numbers, dtype=numpy.int64),
+                                     numpy.concatenate([[0], numpy.cumsum(size)]),
+                                     pks=numpy.array(pks, dtype=numpy.int64))
+        return structure_set
 
-    def get_structure(self, idx):
+    @classmethod
+    def from_iterable(cls, structures, chunk_size=10000):
         """
-        Return structure as StructureData by index
-        """
-        from aiida.orm import StructureData
-        from ase.atoms import Atoms
+        Create a StructureSet from an iterable of structures, consumed lazily.
 
-        cell = self.get_cells()[idx]
+        The structures are converted ``chunk_size`` at a time and each chunk
+        is spilled to temporary .npy files. The final arrays are then
+        assembled in memory-mapped files and stored from there, so the
+        memory needed is bounded by the chunk size, not by the number of
+        structures.
 
-        n = self.size[idx]
-        nframes = self.get_nframes()
-        cnframes = self.get_cnframes()
+        :param structures: an iterable, e.g. a generator, of
+            ``ase.atoms.Atoms`` or StructureData.
+        :param chunk_size: the number of structures held in memory at once.
+        :return: a new, unstored StructureSet.
 
-        start = cnframes[idx]
-        end = cnframes[idx] + nframes[idx]
-        arr_positions = self.get_positions()[start:end,:,:]
-        arr_atomic_numbers = self.get_atomic_numbers()[start:end, :]
-        positions = arr_positions.reshape([n,3])
-        atomic_numbers = arr_atomic_numbers.reshape([n])
+        :raises ValueError: if the iterable is empty.
+        """
+        import itertools
+
+        def iter_chunks():
+            iterator = iter(structures)
+            while True:
+                structurelist = [_to_ase(x) for x in itertools.islice(iterator, chunk_size)]
+                if not structurelist:
+                    return
+                yield dict(zip(('cells', 'positions', 'atomic_numbers', 'size'), _get_raws(structurelist)))
+
+        return cls._from_chunks(iter_chunks())
+
+    @classmethod
+    def _from_chunks(cls, chunks):
+        """
+        Create a StructureSet from chunks of structures, each spilled to
+        temporary .npy files and then assembled in memory-mapped files.
+
+        :param chunks: an iterable of dicts of the arrays ``cells``,
+            ``positions``, ``atomic_numbers`` and ``size`` of the structures
+            of the chunk, and optionally of the labels ``energies``,
+            ``forces`` and ``virials``. A label is kept if all the chunks have it.
+        :return: a new, unstored StructureSet.
+
+        :raises ValueError: if there is no chunk.
+        """
+        import os
+        import tempfile
+        import numpy
+        from numpy.lib.format import open_memmap
+
+        labels = ('energies', 'forces', 'virials')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            def chunk_file(name, ichunk):
+                return os.path.join(tmpdir, '{}.{}.npy'.format(name, ichunk))
+
+            nchunks = 0
+            labelled = set(labels)
+            for chunk in chunks:
+                for name, array in chunk.items():
+                    numpy.save(chunk_file(name, nchunks), array)
+                labelled &= set(chunk)
+                nchunks += 1
+
+            if not nchunks:
+                raise ValueError('structures must contain at least one structure')
+
+            size = numpy.concatenate([numpy.load(chunk_file('size', i)) for i in range(nchunks)])
+            offsets = numpy.concatenate([[0], numpy.cumsum(size)])
+
+            # the arrays with one row per structure, and with one row per atom
+            shapes = {
+                'cells': (len(size), 3, 3),
+                'positions': (offsets[-1], 3),
+                'atomic_numbers': (offsets[-1],),
+                'energies': (len(size),),
+                'forces': (offsets[-1], 3),
+                'virials': (len(size), 3, 3),
+            }
+            per_atom = {'positions', 'atomic_numbers', 'forces'}
+            names = [name for name in shapes if name not in labels or name in labelled]
+            arrays = {
+                name: open_memmap(os.path.join(tmpdir, name + '.npy'),
+                                  mode='w+',
+                                  dtype=numpy.int64 if name == 'atomic_numbers' else float,
+                                  shape=shapes[name]) for name in names
+            }
+            frame, atom = 0, 0
+            for i in range(nchunks):
+                nframes, natoms = 0, 0
+                for name in names:
+                    array = numpy.load(chunk_file(name, i)).reshape((-1,) + shapes[name][1:])
+                    start = atom if name in per_atom else frame
+                    arrays[name][start:start + len(array)] = array
+                    if name in per_atom:
+                        natoms = len(array)
+                    else:
+                        nframes = len(array)
+                frame, atom = frame + nframes, atom + natoms
+
+            structure_set = cls()
+            structure_set.set_collection(arrays['cells'], arrays['positions'], arrays['atomic_numbers'], offsets,
+                                         **{name: arrays[name] for name in labelled})
+            # release the memory maps before the temporary directory is removed
+            del arrays
+
+        return structure_set
+
+    @classmethod
+    def from_extxyz(cls, path, chunk_size=10000):
+        """
+        Create a StructureSet from an extended XYZ file, read in a stream.
+
+        The atom lines of ``chunk_size`` frames are tokenized at once and
+        converted column by column into the arrays of the set, without
+        creating ``ase.atoms.Atoms``, see :py:meth:`_from_chunks` for the
+        memory used. The ``energy``, the ``forces`` (or ``force``) column and
+        the ``virial`` (or ``stress``, converted to a virial) are kept as
+        labels if all the frames have them.
+
+        :param path: the path of the file.
+        :param chunk_size: the number of frames held in memory at once.
+        :return: a new, unstored StructureSet.
+
+        :raises ValueError: if the file is empty or truncated, if a blank
+            line is followed by another frame, or if a frame has no Lattice,
+            no positions, no species or atom lines not matching its properties.
+        """
+        import itertools
+
+        def iter_frames(handle):
+            for header in handle:
+                # trailing blank lines end the file, any other blank line is rejected
+                if not header.strip():
+                    if any(line.strip() for line in handle):
+                        raise ValueError('blank line between the frames of {}'.format(path))
+                    return
+                try:
+                    natoms = int(header)
+                except ValueError:
+                    raise ValueError('invalid number of atoms {!r} in {}'.format(header.strip(), path))
+                comment = next(handle, None)
+                lines = list(itertools.islice(handle, natoms))
+                if comment is None or len(lines) < natoms:
+                    raise ValueError('{} is truncated in a frame of {} atoms'.format(path, natoms))
+                yield comment, lines
+
+        def iter_chunks(frames):
+            while True:
+                chunk = list(itertools.islice(frames, chunk_size))
+                if not chunk:
+                    return
+                for parsed in _parse_extxyz_frames(chunk):
+                    yield parsed
+
+        with open(path) as handle:
+            return cls._from_chunks(iter_chunks(iter_frames(handle)))
+
+    def to_extxyz(self, path, chunk_size=10000):
+        """
+        Write the structures and their labels to an extended XYZ file, in a
+        stream of ``chunk_size`` structures read from the memory-mapped arrays.
+
+        :param path: the path of the file.
+        :param chunk_size: the number of structures formatted at once.
+        """
+        import numpy
+        from ase.data import chemical_symbols
+
+        cells = self.get_cells(mmap=True)
+        positions = self.get_positions(mmap=True)
+        atomic_numbers = self.get_atomic_numbers(mmap=True)
+        offsets = self.get_offsets()
+        energies = self.get_energies(mmap=True)
+        forces = self.get_forces(mmap=True)
+        virials = self.get_virials(mmap=True)
+
+        properties = 'species:S:1:pos:R:3' + (':forces:R:3' if forces is not None else '')
+        ncolumns = 7 if forces is not None else 4
+        atom_format = '{:<2s}' + ' {:16.8f}' * (ncolumns - 1)
+        with open(path, 'w') as handle:
+            for start in range(0, self.length, chunk_size):
+                end = min(start + chunk_size, self.length)
+                # the rows of the atoms of the chunk, as one flat list of python objects
+                rows = numpy.empty([offsets[end] - offsets[start], ncolumns], dtype=object)
+                rows[:, 0] = [chemical_symbols[z] for z in atomic_numbers[offsets[start]:offsets[end]].tolist()]
+                rows[:, 1:4] = numpy.asarray(positions[offsets[start]:offsets[end]], dtype=float)
+                if forces is not None:
+                    rows[:, 4:] = numpy.asarray(forces[offsets[start]:offsets[end]], dtype=float)
+                rows = rows.reshape([-1]).tolist()
+
+                lines = []
+                for i in range(start, end):
+                    natoms = offsets[i + 1] - offsets[i]
+                    comment = ['Lattice="{}"'.format(' '.join(map(repr, cells[i].reshape([-1]).tolist())))]
+                    comment.append('Properties=' + properties)
+                    if energies is not None:
+                        comment.append('energy={!r}'.format(float(energies[i])))
+                    if virials is not None:
+                        comment.append('virial="{}"'.format(' '.join(map(repr, virials[i].reshape([-1]).tolist()))))
+                    comment.append('pbc="T T T"')
+                    lines.append(str(natoms))
+                    lines.append(' '.join(comment))
+                    first = (offsets[i] - offsets[start]) * ncolumns
+                    lines.append(('\n'.join([atom_format] * natoms)).format(*rows[first:first + natoms * ncolumns]))
+                handle.write('\n'.join(lines) + '\n')
+
+    @classmethod
+    def from_ase_db(cls, path, selection=None, chunk_size=10000, **kwargs):
+        """
+        Create a StructureSet from the rows of an ASE database, read in a
+        stream of ``chunk_size`` rows without creating ``ase.atoms.Atoms``.
+        The ``energy``, ``forces`` and ``stress`` (converted to a virial)
+        are kept as labels if all the rows have them.
+
+        :param path: the path of the database, e.g. ``structures.db``.
+        :param selection: the selection of the rows, see ``ase.db.core.Database.select``.
+        :param chunk_size: the number of rows held in memory at once.
+        :param kwargs: the other keyword arguments of ``ase.db.core.Database.select``.
+        :return: a new, unstored StructureSet.
+
+        :raises ValueError: if no row is selected.
+        """
+        import itertools
+        import numpy
+        from ase.db import connect
+
+        def iter_chunks(rows):
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    return
+                arrays = {
+                    'cells': numpy.stack([numpy.asarray(row.cell, dtype=float) for row in chunk]),
+                    'positions': numpy.concatenate([row.positions for row in chunk]),
+                    'atomic_numbers': numpy.concatenate([row.numbers for row in chunk]),
+                    'size': numpy.array([row.natoms for row in chunk], dtype=numpy.int64),
+                }
+                if all(row.get('energy') is not None for row in chunk):
+                    arrays['energies'] = numpy.array([row.energy for row in chunk], dtype=float)
+                if all(row.get('forces') is not None for row in chunk):
+                    arrays['forces'] = numpy.concatenate([row.forces for row in chunk])
+                if all(row.get('stress') is not None for row in chunk):
+                    arrays['virials'] = numpy.stack(
+                        [_stress_to_virial(row.stress, row.cell) for row in chunk])
+                yield arrays
+
+        return cls._from_chunks(iter_chunks(connect(path).select(selection, **kwargs)))
+
+    def to_ase_db(self, path, chunk_size=10000):
+        """
+        Write the structures and their labels to an ASE database, one
+        transaction per ``chunk_size`` structures. The virials are written
+        as the ``stress`` of the rows.
+
+        :param path: the path of the database, e.g. ``structures.db``.
+        :param chunk_size: the number of structures written per transaction.
+        :return: the ids of the rows written.
+        """
+        import numpy
+        from ase.atoms import Atoms
+        from ase.calculators.singlepoint import SinglePointCalculator
+        from ase.db import connect
+
+        cells = self.get_cells(mmap=True)
+        positions = self.get_positions(mmap=True)
+        atomic_numbers = self.get_atomic_numbers(mmap=True)
+        offsets = self.get_offsets()
+        energies = self.get_energies(mmap=True)
+        forces = self.get_forces(mmap=True)
+        virials = self.get_virials(mmap=True)
+
+        ids = []
+        database = connect(path)
+        for start in range(0, self.length, chunk_size):
+            with database:
+                for i in range(start, min(start + chunk_size, self.length)):
+                    atoms = Atoms(cell=cells[i],
+                                  positions=positions[offsets[i]:offsets[i + 1]],
+                                  numbers=atomic_numbers[offsets[i]:offsets[i + 1]],
+                                  pbc=True)
+                    results = {}
+                    if energies is not None:
+                        results['energy'] = float(energies[i])
+                    if forces is not None:
+                        results['forces'] = numpy.array(forces[offsets[i]:offsets[i + 1]], dtype=float)
+                    if virials is not None:
+                        results['stress'] = _virial_to_stress(virials[i], cells[i])
+                    if results:
+                        atoms.calc = SinglePointCalculator(atoms, **results)
+                    ids.append(database.write(atoms))
+        return ids
+
+    @classmethod
+    def from_deepmd_dirs(cls, datadirs, type_map=None):
+        """
+        Create a StructureSet from DeePMD-kit system directories.
+
+        Each system directory contains ``type.raw``, optionally
+        ``type_map.raw``, and ``set.*`` subdirectories with ``coord.npy``,
+        ``box.npy`` and optionally the labels ``energy.npy``, ``force.npy``
+        and ``virial.npy``, which are kept if all the sets have them. The files are
+        memory-mapped and copied into arrays allocated once for all
+        systems, without creating any ``ase.atoms.Atoms``.
+
+        :param datadirs: the list of system directories.
+        :param type_map: the element symbols indexed by the types of
+            ``type.raw``, used for the systems without ``type_map.raw``.
+        :return: a new, unstored StructureSet.
+
+        :raises ValueError: if a system has no type map, an unknown element,
+            a type out of its type map or no ``set.*`` directory.
+        """
+        import glob
+        import os
+        import numpy
+        from ase.data import atomic_numbers as symbol_to_number
+
+        # first pass to read the types and the number of frames of each set
+        sets = []
+        for datadir in datadirs:
+            type_map_file = os.path.join(datadir, 'type_map.raw')
+            if os.path.isfile(type_map_file):
+                with open(type_map_file) as handle:
+                    system_type_map = handle.read().split()
+            elif type_map is not None:
+                system_type_map = type_map
+            else:
+                raise ValueError('no type_map.raw in {} and no type_map given'.format(datadir))
+
+            types = numpy.loadtxt(os.path.join(datadir, 'type.raw'), dtype=int, ndmin=1).reshape([-1])
+            unknown = sorted(set(system_type_map) - set(symbol_to_number))
+            if unknown:
+                raise ValueError('unknown elements {} in the type map of {}'.format(', '.join(unknown), datadir))
+            if len(types) and not 0 <= types.min() <= types.max() < len(system_type_map):
+                raise ValueError('the types of {} are not in [0, {})'.format(datadir, len(system_type_map)))
+            numbers = numpy.array([symbol_to_number[e] for e in system_type_map], dtype=numpy.int64)[types]
+            set_dirs = sorted(glob.glob(os.path.join(datadir, 'set.*')))
+            if not set_dirs:
+                raise ValueError('no set.* directory in {}'.format(datadir))
+            for set_dir in set_dirs:
+                nframes = len(numpy.load(os.path.join(set_dir, 'box.npy'), mmap_mode='r'))
+                sets.append((set_dir, numbers, nframes))
+
+        number_of_structures = sum(nframes for _, _, nframes in sets)
+        number_of_atoms = sum(len(numbers) * nframes for _, numbers, nframes in sets)
+
+        def has_label(name):
+            return all(os.path.isfile(os.path.join(set_dir, '{}.npy'.format(name))) for set_dir, _, _ in sets)
+
+        cells = numpy.empty([number_of_structures, 3, 3])
+        positions = numpy.empty([number_of_atoms, 3])
+        atomic_numbers = numpy.empty([number_of_atoms], dtype=numpy.int64)
+        size = numpy.empty([number_of_structures], dtype=numpy.int64)
+        energies = numpy.empty([number_of_structures]) if has_label('energy') else None
+        forces = numpy.empty([number_of_atoms, 3]) if has_label('force') else None
+        virials = numpy.empty([number_of_structures, 3, 3]) if has_label('virial') else None
+
+        def load(set_dir, name):
+            return numpy.load(os.path.join(set_dir, '{}.npy'.format(name)), mmap_mode='r')
+
+        frame, atom = 0, 0
+        for set_dir, numbers, nframes in sets:
+            natoms = len(numbers)
+            frame_end, atom_end = frame + nframes, atom + nframes * natoms
+
+            cells[frame:frame_end] = load(set_dir, 'box').reshape([-1, 3, 3])
+            positions[atom:atom_end] = load(set_dir, 'coord').reshape([-1, 3])
+            atomic_numbers[atom:atom_end].reshape([nframes, natoms])[:] = numbers
+            size[frame:frame_end] = natoms
+            if energies is not None:
+                energies[frame:frame_end] = load(set_dir, 'energy').reshape([-1])
+            if forces is not None:
+                forces[atom:atom_end] = load(set_dir, 'force').reshape([-1, 3])
+            if virials is not None:
+                virials[frame:frame_end] = load(set_dir, 'virial').reshape([-1, 3, 3])
+
+            frame, atom = frame_end, atom_end
+
+        structure_set = cls()
+        structure_set.set_collection(cells, positions, atomic_numbers, numpy.concatenate([[0], numpy.cumsum(size)]),
+                                     energies=energies, forces=forces, virials=virials)
+        return structure_set
+
+    def subset(self, indices, store_provenance=True):
+        """
+        Return a new StructureSet with the structures at ``indices``.
+
+        The arrays are memory-mapped and gathered with fancy indexing, so the
+        cost scales with the size of the subset, not of the set.
+
+        :param indices: the indices of the structures, negative ones counting
+            from the end. The ``indices`` array of the subset gives the
+            positions within the subset, like for any set.
+        :param store_provenance: create the subset through the calcfunction
+            :py:func:`~aiida_deepmd.calculations.functions.get_structure_subset`,
+            which stores this node. Otherwise return an unstored node.
+
+        :raises IndexError: if an index is out of range.
+        """
+        import numpy
+
+        indices = numpy.asarray(indices, dtype=numpy.int64).reshape([-1])
+        out_of_range = numpy.flatnonzero((indices < -self.length) | (indices >= self.length))
+        if len(out_of_range):
+            raise IndexError('structure indices {} out of range'.format(_format_indices(indices[out_of_range])))
+        indices = numpy.where(indices < 0, indices + self.length, indices)
+
+        if store_provenance:
+            from aiida.orm import List
+            from aiida_deepmd.calculations.functions import get_structure_subset
+
+            return get_structure_subset(self, List(list=indices.tolist()))
+
+        offsets = self.get_offsets()
+        size = offsets[indices + 1] - offsets[indices]
+        subset_offsets = numpy.concatenate([[0], numpy.cumsum(size)])
+        # the indices of the atoms of the selected structures, in order
+        atom_indices = numpy.repeat(offsets[indices] - subset_offsets[:-1], size) + numpy.arange(subset_offsets[-1])
+
+        def take(array, rows):
+            return None if array is None else array[rows]
+
+        subset = StructureSet()
+        subset.set_collection(self.get_cells(mmap=True)[indices],
+                              self.get_positions(mmap=True)[atom_indices],
+                              self.get_atomic_numbers(mmap=True)[atom_indices],
+                              subset_offsets,
+                              energies=take(self.get_energies(mmap=True), indices),
+                              forces=take(self.get_forces(mmap=True), atom_indices),
+                              virials=take(self.get_virials(mmap=True), indices),
+                              pks=take(self.get_pks(mmap=True), indices))
+        return subset
+
+    def split(self, fractions, seed=None, store_provenance=True):
+        """
+        Split the structures randomly into subsets, e.g. for training and validation.
+
+        :param fractions: the fractions of the structures in each subset,
+            normalized to sum to one, e.g. ``[0.9, 0.1]``.
+        :param seed: the seed of the random permutation, drawn at random if
+            None. It is recorded as an input of the calcfunction.
+        :param store_provenance: create the subsets through the calcfunction
+            :py:func:`~aiida_deepmd.calculations.functions.split_structure_set`,
+            which stores this node. Otherwise return unstored nodes.
+        :return: the list of the subsets.
+        """
+        import numpy
+
+        if seed is None:
+            seed = numpy.random.randint(2**31 - 1)
+
+        if store_provenance:
+            from aiida.orm import Int, List
+            from aiida_deepmd.calculations.functions import split_structure_set
+
+            subsets = split_structure_set(self, List(list=[float(x) for x in fractions]), Int(int(seed)))
+            return [subsets['subset_{}'.format(i)] for i in range(len(fractions))]
+
+        fractions = numpy.asarray(fractions, dtype=float)
+        bounds = numpy.rint(numpy.cumsum(fractions) / fractions.sum() * self.length).astype(numpy.int64)
+        permutation = numpy.random.RandomState(seed).permutation(self.length)
+
+        # sorting the indices of each subset keeps the reads sequential
+        return [
+            self.subset(numpy.sort(part), store_provenance=False)
+            for part in numpy.split(permutation, bounds[:-1])
+        ]
+
+    @classmethod
+    def merge(cls, *structure_sets, store_provenance=True):
+        """
+        Return a new StructureSet with the structures of all the sets, in order.
+
+        The output arrays are allocated once and filled set by set from the
+        memory-mapped arrays, the offsets being rebased. The ``indices`` array
+        of the merged set gives the positions within it, like for any set.
+        Sets stored with the legacy frame layout, whatever their frame size,
+        are merged through the flat view of their atoms. A label, or the
+        ``pks``, is kept only if all the sets have it.
+
+        :param structure_sets: the StructureSet nodes.
+        :param store_provenance: merge through the calcfunction
+            :py:func:`~aiida_deepmd.calculations.functions.merge_structure_sets`,
+            which stores the sets. Otherwise return an unstored node.
+        """
+        import numpy
+
+        if store_provenance:
+            from aiida_deepmd.calculations.functions import merge_structure_sets
+
+            width = len(str(len(structure_sets) - 1))
+            return merge_structure_sets(
+                **{'structure_set_{:0{}d}'.format(i, width): x for i, x in enumerate(structure_sets)})
+        lengths = [x.length for x in structure_sets]
+        natoms = [sum(x.size) for x in structure_sets]
+        frame_starts = numpy.concatenate([[0], numpy.cumsum(lengths)])
+        atom_starts = numpy.concatenate([[0], numpy.cumsum(natoms)])
+
+        def has_label(getter):
+            return all(getter(x) is not None for x in structure_sets)
+
+        cells = numpy.empty([frame_starts[-1], 3, 3])
+        positions = numpy.empty([atom_starts[-1], 3])
+        atomic_numbers = numpy.empty([atom_starts[-1]], dtype=numpy.int64)
+        offsets = numpy.empty([frame_starts[-1] + 1], dtype=numpy.int64)
+        energies = numpy.empty([frame_starts[-1]]) if has_label(lambda x: x.get_energies(mmap=True)) else None
+        forces = numpy.empty([atom_starts[-1], 3]) if has_label(lambda x: x.get_forces(mmap=True)) else None
+        virials = numpy.empty([frame_starts[-1], 3, 3]) if has_label(lambda x: x.get_virials(mmap=True)) else None
+        pks = numpy.empty([frame_starts[-1]], dtype=numpy.int64) if has_label(lambda x: x.get_pks(mmap=True)) else None
+
+        offsets[0] = 0
+        for i, structure_set in enumerate(structure_sets):
+            frames = slice(frame_starts[i], frame_starts[i + 1])
+            atoms = slice(atom_starts[i], atom_starts[i + 1])
+
+            cells[frames] = structure_set.get_cells(mmap=True)
+            positions[atoms] = structure_set.get_positions(mmap=True)
+            atomic_numbers[atoms] = structure_set.get_atomic_numbers(mmap=True)
+            offsets[frame_starts[i] + 1:frame_starts[i + 1] + 1] = structure_set.get_offsets()[1:] + atom_starts[i]
+            if energies is not None:
+                energies[frames] = structure_set.get_energies(mmap=True)
+            if forces is not None:
+                forces[atoms] = structure_set.get_forces(mmap=True)
+            if virials is not None:
+                virials[frames] = structure_set.get_virials(mmap=True)
+            if pks is not None:
+                pks[frames] = structure_set.get_pks(mmap=True)
+
+        merged = cls()
+        merged.set_collection(cells, positions, atomic_numbers, offsets, energies=energies, forces=forces,
+                              virials=virials, pks=pks)
+        return merged
+
+    def find_duplicates(self, tolerance=1e-2, chunk_size=10000):
+        """
+        Find the structures which are duplicates of each other.
+
+        Each structure is reduced to a canonical fingerprint: the positions
+        wrapped into the cell and quantized on a grid of spacing about
+        ``tolerance`` along the cell vectors, combined with the element of
+        each atom and sorted, so that the order of the atoms does not matter,
+        followed by the cell quantized by ``tolerance``. The fingerprints are
+        hashed to 64 bits and the structures are bucketed by composition and
+        hash, so the cost is linear in the number of structures instead of
+        comparing all pairs.
+
+        Structures within ``tolerance`` of each other can still fall on both
+        sides of a grid boundary and be reported as distinct.
+
+        :param tolerance: the quantization step, in Angstrom.
+        :param chunk_size: the number of structures processed at once.
+        :return: a tuple ``(unique_indices, duplicate_groups)``, the sorted
+            indices of the first structure of each group and the list of the
+            groups with more than one structure, as sorted lists of indices.
+        """
+        import numpy
+
+        lookup = _get_type_lookup(self.get_elements())
+        _, composition_ids = numpy.unique(self._get_element_counts(), axis=0, return_inverse=True)
+        composition_ids = composition_ids.reshape([-1])
+
+        cells = self.get_cells(mmap=True)
+        positions = self.get_positions(mmap=True)
+        atomic_numbers = self.get_atomic_numbers(mmap=True)
+        offsets = self.get_offsets()
+        size = numpy.diff(offsets)
+
+        rng = numpy.random.RandomState(0)
+        hashes = numpy.empty([self.length], dtype=numpy.uint64)
+        for natoms in numpy.unique(size):
+            indices = numpy.flatnonzero(size == natoms)
+            # odd random multipliers, the products and sums wrap around modulo 2**64
+            multipliers = rng.randint(0, 2**62, natoms + 9).astype(numpy.uint64) * 2 + 1
+
+            for start in range(0, len(indices), chunk_size):
+                chunk = indices[start:start + chunk_size]
+                atom_indices = offsets[chunk][:, None] + numpy.arange(natoms)
+                cell = numpy.asarray(cells[chunk], dtype=float)
+
+                scaled = numpy.einsum('kni,kij->knj', positions[atom_indices], numpy.linalg.inv(cell)) % 1.
+                nbins = numpy.maximum(numpy.rint(numpy.linalg.norm(cell, axis=2) / tolerance), 1).astype(numpy.int64)
+                nbins = nbins[:, None, :]
+                grid = numpy.rint(scaled * nbins).astype(numpy.int64) % nbins
+
+                keys = lookup[atomic_numbers[atom_indices]]
+                for axis in range(3):
+                    keys = keys * nbins[..., axis] + grid[..., axis]
+                keys.sort(axis=1)
+
+                fingerprints = numpy.concatenate(
+                    [keys, numpy.rint(cell.reshape([-1, 9]) / tolerance).astype(numpy.int64)], axis=1)
+                hashes[chunk] = (fingerprints.astype(numpy.uint64) * multipliers).sum(axis=1, dtype=numpy.uint64)
+
+        order = numpy.lexsort((numpy.arange(self.length), hashes, composition_ids))
+        new_group = numpy.ones([self.length], dtype=bool)
+        new_group[1:] = (numpy.diff(composition_ids[order]) != 0) | (numpy.diff(hashes[order]) != 0)
+        starts = numpy.flatnonzero(new_group)
+
+        groups = numpy.split(order, starts[1:])
+        duplicate_groups = sorted(x.tolist() for x in groups if len(x) > 1)
+        return numpy.sort(order[starts]), duplicate_groups
+
+    def find_close_contacts(self, rmin, max_workers=None):
+        """
+        Find the structures with atoms closer than ``rmin``, taking the
+        periodic images into account.
+
+        Each structure is checked with a vectorized cell-list search, which
+        only compares the atoms of neighbouring bins instead of computing
+        the full distance matrix.
+
+        :param rmin: the minimum allowed distance, in Angstrom.
+        :param max_workers: check the structures in that many threads. The
+            search runs in numpy, which releases the GIL.
+        :return: the sorted indices of the offending structures.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        import numpy
+
+        cells = self.get_cells(mmap=True)
+        positions = self.get_positions(mmap=True)
+        offsets = self.get_offsets()
+
+        def check(idx):
+            return _has_close_contact(numpy.asarray(positions[offsets[idx]:offsets[idx + 1]], dtype=float),
+                                      numpy.asarray(cells[idx], dtype=float), rmin)
+
+        if max_workers is None or max_workers == 1:
+            flags = [check(idx) for idx in range(self.length)]
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                flags = list(executor.map(check, range(self.length)))
+
+        return numpy.flatnonzero(flags)
+
+    def get_features(self):
+        """
+        Return a cheap feature vector of each structure, used to select diverse structures.
+
+        The columns are the fraction of each element, the volume per atom
+        and, if set, the energy per atom and the mean norm of the forces,
+        each standardized to zero mean and unit variance.
+
+        :return: float array of shape (N, number of features).
+        """
+        import numpy
+
+        offsets = self.get_offsets()
+        size = numpy.diff(offsets)
+        cells = self.get_cells(mmap=True)
+
+        columns = [self._get_element_counts() / size[:, None]]
+        volumes = numpy.abs(numpy.einsum('ki,ki->k', cells[:, 0], numpy.cross(cells[:, 1], cells[:, 2])))
+        columns.append((volumes / size)[:, None])
+
+        energies = self.get_energies(mmap=True)
+        if energies is not None:
+            columns.append((energies / size)[:, None])
+        forces = self.get_forces(mmap=True)
+        if forces is not None:
+            norms = numpy.linalg.norm(forces, axis=1)
+            columns.append((numpy.add.reduceat(norms, offsets[:-1]) / size)[:, None])
+
+        features = numpy.concatenate(columns, axis=1).astype(float)
+        std = features.std(axis=0)
+        return (features - features.mean(axis=0)) / numpy.where(std > 0, std, 1.)
+
+    def select_farthest_points(self, budget, features=None):
+        """
+        Select a diverse subset of structures by farthest point sampling.
+
+        Starting from the structure farthest from the mean, each step picks
+        the structure farthest from all the structures already picked. Only
+        the distance of each structure to the picked ones is kept, so the
+        time is O(N k) and the memory O(N) for k structures.
 
-        ase_structure = Atoms(cell=cell, positions=positions, numbers=atomic_numbers, pbc=True)
-        return StructureData(ase=ase_structure)
+        :param budget: the number of structures to select.
+        :param features: a float array of shape (N, number of features),
+            :py:meth:`get_features` if None.
+        :return: the indices of the structures, in the order they are picked.
 
-    def get_cells(self):
+        :raises ValueError: if the budget is larger than the number of structures.
+        """
+        import numpy
+
+        if budget > self.length:
+            raise ValueError('budget {} is larger than the {} structures'.format(budget, self.length))
+        if features is None:
+            features = self.get_features()
+        features = numpy.asarray(features, dtype=float)
+
+        # the squared distances are expanded as |x|^2 - 2 x.c + |c|^2, one
+        # matrix-vector product per step and no (N, number of features)
+        # temporary; single precision is plenty for centred features
+        features = numpy.ascontiguousarray(features - features.mean(axis=0), dtype=numpy.float32)
+        norms = numpy.einsum('ij,ij->i', features, features)
+
+        selected = numpy.empty([budget], dtype=numpy.int64)
+        distances = numpy.full([len(features)], numpy.inf, dtype=numpy.float32)
+        candidate = numpy.empty_like(distances)
+        farthest = numpy.argmax(norms)
+        for i in range(budget):
+            selected[i] = farthest
+            numpy.dot(features, features[farthest], out=candidate)
+            candidate *= -2.
+            candidate += norms
+            candidate += norms[farthest]
+            numpy.minimum(distances, candidate, out=distances)
+            farthest = numpy.argmax(distances)
+        return selected
+
+    def select_stratified(self, budget, nbins=10, seed=None):
+        """
+        Select structures at random, stratified by composition and energy per atom.
+
+        The structures are grouped by composition, then by ``nbins``
+        quantiles of the energy per atom if the energies are set. The budget
+        is split between the groups in proportion of their size, and the
+        structures are drawn at random in each group.
+
+        :param budget: the number of structures to select.
+        :param nbins: the number of energy per atom quantiles in each composition.
+        :param seed: the seed of the random generator.
+        :return: the sorted indices of the structures.
+
+        :raises ValueError: if the budget is larger than the number of structures.
+        """
+        import numpy
+
+        if budget > self.length:
+            raise ValueError('budget {} is larger than the {} structures'.format(budget, self.length))
+
+        _, strata = numpy.unique(self._get_element_counts(), axis=0, return_inverse=True)
+        strata = strata.reshape([-1])
+        energies = self.get_energies(mmap=True)
+        if energies is not None:
+            energies = energies / numpy.diff(self.get_offsets())
+            bins = numpy.zeros_like(strata)
+            for composition in numpy.unique(strata):
+                members = numpy.flatnonzero(strata == composition)
+                edges = numpy.quantile(energies[members], numpy.linspace(0., 1., nbins + 1)[1:-1])
+                bins[members] = numpy.searchsorted(edges, energies[members], side='right')
+            _, strata = numpy.unique(strata * nbins + bins, return_inverse=True)
+
+        # split the budget in proportion of the sizes, the remainder going to the largest fractional parts
+        counts = numpy.bincount(strata)
+        quotas = budget * counts / float(self.length)
+        allocation = numpy.floor(quotas).astype(numpy.int64)
+        remainder = numpy.argsort(allocation - quotas, kind='stable')[:budget - allocation.sum()]
+        allocation[remainder] += 1
+
+        # rank the structures at random in each stratum and keep the first ones
+        order = numpy.lexsort((numpy.random.RandomState(seed).random_sample(self.length), strata))
+        starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+        ranks = numpy.arange(self.length) - starts[strata[order]]
+        return numpy.sort(order[ranks < allocation[strata[order]]])
+
+    def export_deepmd(self, path, set_size=5000, type_map=None):
+        """
+        Write the structures as DeePMD-kit systems under ``path``.
+
+        Structures with the same composition are gathered in one system
+        directory named after the formula in Hill notation, with the atoms of each structure
+        sorted by element to match ``type.raw``. The ``type_map`` is written
+        as ``type_map.raw``. Frames are written in ``set.NNN``
+        subdirectories of at most ``set_size`` frames, ``coord.npy``,
+        ``box.npy`` and the labels (``energy.npy``, ``force.npy``,
+        ``virial.npy``) if they have been set.
+
+        The arrays are memory-mapped and written one set at a time, so the
+        memory needed is bounded by ``set_size``.
+
+        :param path: the directory in which the systems are written.
+        :param set_size: the maximum number of frames in a ``set.NNN`` directory.
+        :param type_map: the chemical symbols of the types,
+            :py:meth:`get_elements` if None. Several sets exported with the same type map
+            can be trained together.
+        :return: the list of the system directories.
+
+        :raises ValueError: if an element is missing from ``type_map``.
+        """
+        import os
+        import numpy
+
+        if type_map is None:
+            type_map = self.get_elements()
+            counts = self._get_element_counts()
+        else:
+            missing = set(self.get_elements()) - set(type_map)
+            if missing:
+                raise ValueError('the elements {} are not in the type map'.format(', '.join(sorted(missing))))
+            counts = _count_elements(self.get_atomic_numbers(mmap=True), self.get_offsets(), type_map)
+        lookup = _get_type_lookup(type_map)
+        compositions, system_ids = numpy.unique(counts, axis=0, return_inverse=True)
+        system_ids = system_ids.reshape([-1])
+
+        cells = self.get_cells(mmap=True)
+        positions = self.get_positions(mmap=True)
+        atomic_numbers = self.get_atomic_numbers(mmap=True)
+        offsets = self.get_offsets()
+        energies = self.get_energies(mmap=True)
+        forces = self.get_forces(mmap=True)
+        virials = self.get_virials(mmap=True)
+
+        systems = []
+        for system_id, composition in enumerate(compositions):
+            system_dir = os.path.join(path, _get_formula(type_map, composition))
+            os.makedirs(system_dir, exist_ok=True)
+
+            natoms = int(composition.sum())
+            numpy.savetxt(os.path.join(system_dir, 'type.raw'),
+                          numpy.repeat(numpy.arange(len(type_map)), composition),
+                          fmt='%d')
+            with open(os.path.join(system_dir, 'type_map.raw'), 'w') as handle:
+                handle.write('\n'.join(type_map) + '\n')
+
+            indices = numpy.flatnonzero(system_ids == system_id)
+            for iset, start in enumerate(range(0, len(indices), set_size)):
+                chunk = indices[start:start + set_size]
+                nchunk = len(chunk)
+
+                # order the atoms of each structure by element to match type.raw
+                atom_indices = offsets[chunk][:, None] + numpy.arange(natoms)
+                order = numpy.argsort(lookup[atomic_numbers[atom_indices]], axis=1, kind='stable')
+                atom_indices = numpy.take_along_axis(atom_indices, order, axis=1)
+
+                set_dir = os.path.join(system_dir, 'set.{:03d}'.format(iset))
+                os.makedirs(set_dir, exist_ok=True)
+                numpy.save(os.path.join(set_dir, 'box.npy'), cells[chunk].reshape([nchunk, 9]))
+                numpy.save(os.path.join(set_dir, 'coord.npy'), positions[atom_indices].reshape([nchunk, -1]))
+                if energies is not None:
+                    numpy.save(os.path.join(set_dir, 'energy.npy'), energies[chunk])
+                if forces is not None:
+                    numpy.save(os.path.join(set_dir, 'force.npy'), forces[atom_indices].reshape([nchunk, -1]))
+                if virials is not None:
+                    numpy.save(os.path.join(set_dir, 'virial.npy'), virials[chunk].reshape([nchunk, 9]))
+
+            systems.append(system_dir)
+
+        return systems
+
+    def _get_element_counts(self):
+        """
+        Return the number of atoms of each element in each structure.
+
+        :return: int array of shape (N, number of elements), the columns
+            following :py:meth:`get_elements`.
+        """
+        return _count_elements(self.get_atomic_numbers(mmap=True), self.get_offsets(), self.get_elements())
+
+    def _set_composition_index(self, elements, counts):
+        """
+        Set the attributes describing the composition of the structures, so
+        that they can be queried without reading the arrays:
+
+        * ``formulas``: the sorted distinct formulas, in Hill notation, the
+          formula of each structure being given by the ``formula_indices``
+          array, see :py:meth:`get_formulas`.
+        * ``compositions``: for each formula, the number of atoms of each
+          element (``counts``), the number of atoms (``natoms``) and the
+          number of structures (``number``).
+        * ``chemical_systems``: for each chemical system, e.g. ``Cu-O``, the
+          sorted distinct numbers of atoms (``natoms``) and the number of
+          structures (``number``). See :py:meth:`get_composition_filters`.
+        """
+        import numpy
+
+        unique_counts, inverse, number = numpy.unique(counts, axis=0, return_inverse=True, return_counts=True)
+        unique_formulas = [_get_formula(elements, x) for x in unique_counts]
+        # the formulas are sorted to be indexed independently of the order of the counts
+        order = numpy.argsort(unique_formulas)
+        ranks = numpy.empty_like(order)
+        ranks[order] = numpy.arange(len(order))
+
+        compositions = {}
+        chemical_systems = {}
+        for formula, composition, nstructures in zip(unique_formulas, unique_counts, number):
+            natoms = int(composition.sum())
+            compositions[formula] = {
+                'counts': {e: int(n) for e, n in zip(elements, composition) if n},
+                'natoms': natoms,
+                'number': int(nstructures),
+            }
+            system = '-'.join(sorted(e for e, n in zip(elements, composition) if n))
+            chemical_system = chemical_systems.setdefault(system, {'natoms': [], 'number': 0})
+            chemical_system['natoms'] = sorted(set(chemical_system['natoms']) | {natoms})
+            chemical_system['number'] += int(nstructures)
+
+        self.set_attribute('formulas', sorted(unique_formulas))
+        self.set_array('formula_indices', ranks[inverse.reshape([-1])])
+        self.set_attribute('compositions', compositions)
+        self.set_attribute('chemical_systems', chemical_systems)
+
+    def _set_statistics(self, offsets, **labels):
+        """
+        Update the ``statistics`` attribute for the labels given, a label
+        given as None being dropped. The attribute is a dict of:
+
+        * ``counts``: the number of ``structures``, of ``atoms`` and of
+          structures with each label.
+        * ``natoms``: the histogram of the number of atoms, as
+          {number of atoms: number of structures}.
+        * ``energy_per_atom``: the ``min``, ``max``, ``mean`` and ``std`` of
+          the energy per atom of ``all`` the structures and of each formula
+          (``formulas``).
+        * ``force_norm``: the 50th, 90th and 99th percentiles (``p50``,
+          ``p90``, ``p99``) and the ``max`` of the norms of the forces,
+          computed in chunks, see :py:func:`_get_norm_percentiles`.
+
+        It can be projected for many sets at once without reading any array,
+        e.g. ``project=['attributes.statistics.energy_per_atom.all']``.
+
+        :param offsets: the offsets of the structures.
+        :param labels: ``energies``, ``forces`` or ``virials``.
+        """
+        import numpy
+
+        statistics = self.get_attribute('statistics', {})
+        natoms = numpy.diff(offsets)
+        counts = statistics.get('counts', {})
+        counts.update({'structures': len(natoms), 'atoms': int(offsets[-1])})
+        histogram = numpy.unique(natoms, return_counts=True)
+        statistics['natoms'] = {str(n): int(number) for n, number in zip(*histogram)}
+
+        for name, values in labels.items():
+            counts[name] = 0 if values is None else len(natoms)
+
+        if 'energies' in labels:
+            energies = labels['energies']
+            statistics.pop('energy_per_atom', None)
+            if energies is not None:
+                energy_per_atom = numpy.asarray(energies, dtype=float) / natoms
+                formulas, groups = numpy.unique(self.get_formulas(), return_inverse=True)
+                statistics['energy_per_atom'] = {
+                    'all': _describe(energy_per_atom),
+                    'formulas': dict(zip(formulas.tolist(), _describe(energy_per_atom, groups.reshape([-1])))),
+                }
+
+        if 'forces' in labels:
+            forces = labels['forces']
+            statistics.pop('force_norm', None)
+            if forces is not None:
+                maximum, percentiles = _get_norm_percentiles(forces, offsets, [50, 90, 99])
+                statistics['force_norm'] = dict(zip(['p50', 'p90', 'p99'], percentiles), max=maximum)
+
+        statistics['counts'] = counts
+        self.set_attribute('statistics', statistics)
+
+    @classmethod
+    def get_composition_filters(cls, elements, min_atoms=None, max_atoms=None):
+        """
+        Return the QueryBuilder filters selecting the sets that contain
+        structures of the chemical system ``elements`` with a number of atoms
+        between ``min_atoms`` and ``max_atoms``, e.g.::
+
+            filters = StructureSet.get_composition_filters(['Cu', 'O'], 64, 128)
+            QueryBuilder().append(StructureSet, filters=filters)
+
+        The filters only touch the attributes, not the arrays. A range of
+        number of atoms is resolved by one query projecting the ``natoms``
+        of the chemical system of the sets, which gives an ``in`` filter on
+        the pks of the matching sets. The indices of the matching structures
+        can then be found from :py:meth:`get_formulas` and the ``size``
+        attribute.
+
+        :param elements: the chemical symbols of the chemical system.
+        :param min_atoms: the minimum number of atoms, if any.
+        :param max_atoms: the maximum number of atoms, required if ``min_atoms`` is given.
+        """
+        system = '-'.join(sorted(elements))
+        if min_atoms is None and max_atoms is None:
+            return {'attributes.chemical_systems': {'has_key': system}}
+        if max_atoms is None:
+            raise ValueError('max_atoms is required to filter on the number of atoms')
+
+        from aiida.orm import QueryBuilder
+
+        min_atoms = 1 if min_atoms is None else min_atoms
+        query = QueryBuilder().append(cls,
+                                      filters={'attributes.chemical_systems': {'has_key': system}},
+                                      project=['id', 'attributes.chemical_systems.{}.natoms'.format(system)])
+        pks = [pk for pk, natoms in query.iterall() if any(min_atoms <= n <= max_atoms for n in natoms)]
+        return {'id': {'in': pks}}
+
+    def set_energies(self, energies):
+        """
+        :param energies: energies is a arrayable type. list or array.
+        The number of elements of energies should be equal to number of structures.
+
+        :raises ValueError: if the shape is wrong or an energy is not finite.
+        """
+        energies = _as_float(energies)
+        offsets = self.get_offsets()
+        _validate_labels(offsets, energies=energies)
+        self.set_array('energies', energies)
+        self._set_statistics(offsets, energies=energies)
+
+    def set_forces(self, forces):
+        """
+        :param forces: the forces on the atoms, either an arrayable of shape
+            (Natoms, 3) aligned with the positions, or a list with the
+            (natoms, 3) forces of each structure.
+
+        :raises ValueError: if the number of forces differs from the number
+            of atoms or a force is not finite.
+        """
+        forces = _as_forces(forces)
+        offsets = self.get_offsets()
+        _validate_labels(offsets, forces=forces)
+        self.set_array('forces', forces)
+        self._set_statistics(offsets, forces=forces)
+
+    def set_virials(self, virials):
+        """
+        :param virials: the virials of the structures, an arrayable of shape
+            (N, 3, 3) or (N, 9).
+
+        :raises ValueError: if the number of virials differs from the number
+            of structures or a virial is not finite.
+        """
+        virials = _as_float(virials).reshape([-1, 3, 3])
+        offsets = self.get_offsets()
+        _validate_labels(offsets, virials=virials)
+        self.set_array('virials', virials)
+        self._set_statistics(offsets, virials=virials)
+
+    def get_structure(self, idx):
+        """
+        Return structure as StructureData by index
+        """
+        return next(self.iter_structures([idx]))
+
+    def get_structures(self, indices=None, as_ase=False, mmap=False):
+        """
+        Return a list of structures by indices.
+
+        :param indices: the indices of the structures, all the structures if None.
+        :param as_ase: return ``ase.atoms.Atoms`` instead of StructureData.
+        :param mmap: memory-map the arrays, see :py:meth:`get_array`.
+        """
+        return list(self.iter_structures(indices, as_ase=as_ase, mmap=mmap))
+
+    def iter_structures(self, indices=None, as_ase=False, mmap=False):
+        """
+        Iterate over structures by indices.
+
+        Each array is loaded only once and sliced by the offsets of the
+        structures, which are yielded lazily,
+        so iterating over the whole set is linear in the number of structures.
+
+        :param indices: the indices of the structures, all the structures if None.
+        :param as_ase: yield ``ase.atoms.Atoms`` instead of StructureData.
+        :param mmap: memory-map the arrays, see :py:meth:`get_array`. Only the
+            pages of the requested structures are then read from disk.
+        """
+        from aiida.orm import StructureData
+        from ase.atoms import Atoms
+
+        structure_range = range(self.length)
+        if indices is None:
+            indices = structure_range
+
+        cells = self.get_cells(mmap=mmap)
+        positions = self.get_positions(mmap=mmap)
+        atomic_numbers = self.get_atomic_numbers(mmap=mmap)
+        offsets = self.get_offsets()
+
+        for idx in indices:
+            # negative indices count from the end, out of range ones raise IndexError
+            idx = structure_range[idx]
+            start, end = offsets[idx], offsets[idx + 1]
+            ase_structure = Atoms(cell=cells[idx],
+                                  positions=positions[start:end],
+                                  numbers=atomic_numbers[start:end],
+                                  pbc=True)
+            if as_ase:
+                yield ase_structure
+            else:
+                yield StructureData(ase=ase_structure)
+
+    def get_array(self, name, mmap=False):
+        """
+        Return an array stored in the node.
+
+        :param name: the name of the array.
+        :param mmap: open the array as a read-only ``numpy.memmap`` if its file
+            is on the local disk, so that slicing reads only the pages needed.
+            Falls back to loading the full array for other repository backends
+            and for compressed arrays.
+
+        Arrays loaded in full are decoded once and kept in a cache of bounded
+        memory, see :py:meth:`set_cache_size`. The array returned is then
+        shared with the cache and read-only, as are the arrays returned by
+        the getters: copy it before modifying it, e.g. ``get_positions().copy()``.
+
+        :raises KeyError: if the array does not exist.
+        """
+        import numpy
+
+        if mmap:
+            filepath = self._get_array_filepath(name)
+            if filepath is not None:
+                return numpy.load(filepath, mmap_mode='r', allow_pickle=False)
+
+        if name in self._array_cache:
+            self._array_cache.move_to_end(name)
+            return self._array_cache[name]
+
+        object_names = self.list_object_names()
+        npz_filename = '{}.npz'.format(name)
+        npy_filename = '{}.npy'.format(name)
+        if npz_filename in object_names:
+            with self.open(npz_filename, mode='rb') as handle:
+                with numpy.load(handle, allow_pickle=False) as npz:
+                    array = npz['arr_0']
+        elif npy_filename in object_names:
+            # read the file directly, the cache of ArrayData is not bounded
+            with self.open(npy_filename, mode='rb') as handle:
+                array = numpy.load(handle, allow_pickle=False)
+        else:
+            raise KeyError('Array with name `{}` does not exist.'.format(name))
+
+        self._cache_array(name, array)
+        return array
+
+    def _get_array_filepath(self, name):
+        """
+        Return the absolute path of the file of an array, or None if the
+        repository does not keep it as a file on the local disk.
+        """
+        import os
+
+        try:
+            filepath = self._repository._get_base_folder().get_abs_path('{}.npy'.format(name))  # pylint: disable=protected-access
+        except (AttributeError, NotImplementedError):
+            return None
+
+        if not os.path.isfile(filepath):
+            return None
+        return filepath
+
+    def get_cells(self, mmap=False):
         """
         Return the array of cells, if it has already been set.
         """
-        return self.get_array('cells')
+        return self.get_array('cells', mmap=mmap)
 
-    def get_positions(self):
+    def get_positions(self, mmap=False):
         """
-        Return the array of positions, if it has already been set.
+        Return the array of positions of all atoms, shape (Natoms, 3).
         """
-        return self.get_array('positions')
+        # the reshape flattens the frames of the legacy layout and is a no-op otherwise
+        return self.get_array('positions', mmap=mmap).reshape([-1, 3])
 
-    def get_atomic_numbers(self):
+    def get_atomic_numbers(self, mmap=False):
         """
-        Return the array of atomic numbers.
+        Return the array of atomic numbers of all atoms, shape (Natoms,).
         """
-        return self.get_array('atomic_numbers')
+        return self.get_array('atomic_numbers', mmap=mmap).reshape([-1])
 
-    def get_nframes(self):
-        return self.get_array('nframes')
+    def get_offsets(self, mmap=False):
+        """
+        Return the offsets of the structures in the atom arrays, length N+1.
+        The atoms of the i-th structure are ``offsets[i]:offsets[i+1]``.
+        """
+        import numpy
 
-    def get_cnframes(self):
-        return self.get_array('cnframes')
+        if self._is_frame_layout():
+            if 'offsets' in self._array_cache:
+                return self._array_cache['offsets']
+            offsets = numpy.concatenate([[0], numpy.cumsum(self.size, dtype=numpy.int64)])
+            self._cache_array('offsets', offsets)
+            return offsets
+        return self.get_array('offsets', mmap=mmap)
+
+    def get_pks(self, mmap=False):
+        """
+        Return the pks of the StructureData nodes the structures come from,
+        None if the set was not created from the database.
+        """
+        try:
+            return self.get_array('pks', mmap=mmap)
+        except (AttributeError, KeyError):
+            return None
 
-    def get_energies(self):
+    def get_energies(self, mmap=False):
         """
         Return the energies labeled for the structures.
         """
         try:
-            return self.get_array('energies')
+            return self.get_array('energies', mmap=mmap)
+        except (AttributeError, KeyError):
+            return None
+
+    def get_forces(self, idx=None, mmap=False):
+        """
+        Return the forces labeled for the atoms, shape (Natoms, 3), or the
+        forces of the structure ``idx`` if given. None if not set.
+        """
+        try:
+            forces = self.get_array('forces', mmap=mmap)
         except (AttributeError, KeyError):
             return None
+
+        if idx is None:
+            return forces
+        idx = range(self.length)[idx]
+        offsets = self.get_offsets()
+        return forces[offsets[idx]:offsets[idx + 1]]
+
+    def get_virials(self, idx=None, mmap=False):
+        """
+        Return the virials labeled for the structures, shape (N, 3, 3), or
+        the virial of the structure ``idx`` if given. None if not set.
+        """
+        try:
+            virials = self.get_array('virials', mmap=mmap)
+        except (AttributeError, KeyError):
+            return None
+
+        if idx is None:
+            return virials
+        return virials[idx]
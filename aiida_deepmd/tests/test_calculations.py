@@ -2,6 +2,9 @@
 
 """
 import os
+
+import pytest
+
 from aiida_deepmd import tests
 
 from aiida import orm
@@ -53,3 +56,178 @@ def test_process(deepmd_code):
 
     assert 'content1' in computed_diff
     assert 'content2' in computed_diff
+
+
+def test_get_data_folder():
+    """Test that the training data of identical content is stored in one FolderData."""
+    from aiida_deepmd.calculations.dp import DpCalculation
+
+    datadirs = [os.path.join(tests.TEST_DIR, 'input_files', name) for name in ['train_data', 'train_data2']]
+    data_folder = DpCalculation.get_data_folder(datadirs)
+    assert data_folder.is_stored
+    assert sorted(data_folder.list_object_names()) == ['train_data', 'train_data2']
+    assert 'box.npy' in data_folder.list_object_names(os.path.join('train_data', 'set.000'))
+
+    # resubmitting the same data stores nothing
+    assert DpCalculation.get_data_folder(datadirs).uuid == data_folder.uuid
+    assert orm.QueryBuilder().append(orm.FolderData).count() == 1
+
+    with pytest.raises(FileNotFoundError):
+        DpCalculation.get_data_folder([os.path.join(tests.TEST_DIR, 'input_files', 'missing')])
+
+
+def test_data_folder(aiida_local_code_factory):
+    """Test that the data folder is copied unpacked and out of the provenance, its top folders as the systems."""
+    import json
+    from aiida.common.folders import SandboxFolder
+    from aiida.engine.utils import instantiate_process
+    from aiida.manage.manager import get_manager
+    from aiida.plugins import CalculationFactory
+
+    with open(os.path.join(tests.TEST_DIR, 'input_files', 'water_se_a.json')) as handle:
+        parameters = json.load(handle)
+    DpCalculation = CalculationFactory('deepmd')
+    data_folder = DpCalculation.get_data_folder(
+        [os.path.join(tests.TEST_DIR, 'input_files', name) for name in ['train_data', 'train_data2']])
+
+    inputs = {
+        'code': aiida_local_code_factory(entry_point='deepmd', executable='diff'),
+        'model': orm.Dict(dict=parameters['model']),
+        'learning_rate': orm.Dict(dict=parameters['learning_rate']),
+        'loss': orm.Dict(dict=parameters['loss']),
+        'training': orm.Dict(dict={key: value for key, value in parameters['training'].items() if key != 'systems'}),
+        'data_folder': data_folder,
+        'metadata': {
+            'dry_run': True,
+            'options': {'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1}},
+        },
+    }
+    process = instantiate_process(get_manager().get_runner(), DpCalculation, **inputs)
+
+    with SandboxFolder() as folder:
+        calc_info = process.prepare_for_submission(folder)
+        with open(folder.get_abs_path('aiida.json')) as handle:
+            written = json.load(handle)
+        assert written['training']['systems'] == ['train_data', 'train_data2']
+        # exactly the files of the data folder are left out of the provenance
+        expected = []
+        for name in ['train_data', 'train_data2']:
+            datadir = os.path.join(tests.TEST_DIR, 'input_files', name)
+            for root, _, files in os.walk(datadir):
+                expected.extend(os.path.join(name, os.path.relpath(os.path.join(root, x), datadir)) for x in files)
+        assert sorted(calc_info.provenance_exclude_list) == sorted(expected)
+        for filename in expected:
+            assert os.path.isfile(folder.get_abs_path(filename))
+        assert not calc_info.prepend_text
+
+
+def test_training_data(aiida_local_code_factory):
+    """Test that the structure sets are written as the training systems of the calculation."""
+    import json
+    from aiida.engine import run_get_node
+    from aiida.plugins import CalculationFactory
+    from aiida_deepmd.data.structure_set import StructureSet
+
+    with open(os.path.join(tests.TEST_DIR, 'input_files', 'water_se_a.json')) as handle:
+        parameters = json.load(handle)
+    datadir = os.path.join(tests.TEST_DIR, 'input_files', 'train_data')
+    structure_set = StructureSet.from_deepmd_dirs([datadir], type_map=['O', 'H'])
+
+    inputs = {
+        'code': aiida_local_code_factory(entry_point='deepmd', executable='diff'),
+        'model': orm.Dict(dict=parameters['model']),
+        'learning_rate': orm.Dict(dict=parameters['learning_rate']),
+        'loss': orm.Dict(dict=parameters['loss']),
+        'training': orm.Dict(dict={key: value for key, value in parameters['training'].items() if key != 'systems'}),
+        'training_data': {'water': structure_set},
+        'metadata': {
+            'dry_run': True,
+            'options': {'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1}},
+        },
+    }
+    _, node = run_get_node(CalculationFactory('deepmd'), **inputs)
+
+    folder = node.dry_run_info['folder']
+    with open(os.path.join(folder, 'aiida.json')) as handle:
+        written = json.load(handle)
+    assert written['training']['systems'] == [os.path.join('training_data', 'water', 'H128O64')]
+    assert written['model']['type_map'] == ['O', 'H']
+    system = os.path.join(folder, 'training_data', 'water', 'H128O64')
+    assert open(os.path.join(system, 'type_map.raw')).read().split() == ['O', 'H']
+    assert os.path.isfile(os.path.join(system, 'set.000', 'energy.npy'))
+
+
+def test_remote_data(aiida_local_code_factory):
+    """Test that the remote datasets are added to the training systems without being uploaded."""
+    import json
+    from aiida.engine import run_get_node
+    from aiida.plugins import CalculationFactory
+
+    with open(os.path.join(tests.TEST_DIR, 'input_files', 'water_se_a.json')) as handle:
+        parameters = json.load(handle)
+    code = aiida_local_code_factory(entry_point='deepmd', executable='diff')
+    remote = orm.RemoteData(computer=code.computer,
+                            remote_path=os.path.join(tests.TEST_DIR, 'input_files', 'train_data'))
+    dataset = orm.RemoteData(computer=code.computer, remote_path=os.path.join(tests.TEST_DIR, 'input_files'))
+
+    inputs = {
+        'code': code,
+        'model': orm.Dict(dict=parameters['model']),
+        'learning_rate': orm.Dict(dict=parameters['learning_rate']),
+        'loss': orm.Dict(dict=parameters['loss']),
+        'training': orm.Dict(dict={key: value for key, value in parameters['training'].items() if key != 'systems'}),
+        'remote_data': {'water': remote, 'dataset': dataset},
+        'remote_systems': {'dataset': orm.List(list=['train_data', 'train_data2'])},
+        'metadata': {
+            'dry_run': True,
+            'options': {'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1}},
+        },
+    }
+    _, node = run_get_node(CalculationFactory('deepmd'), **inputs)
+
+    folder = node.dry_run_info['folder']
+    with open(os.path.join(folder, 'aiida.json')) as handle:
+        written = json.load(handle)
+    assert written['training']['systems'] == [
+        os.path.join('remote_data', 'dataset', 'train_data'),
+        os.path.join('remote_data', 'dataset', 'train_data2'),
+        os.path.join('remote_data', 'water'),
+    ]
+    assert not os.listdir(os.path.join(folder, 'remote_data'))
+
+
+def test_pack_training_data(aiida_local_code_factory):
+    """Test that the training data is uploaded as one archive when packed."""
+    import json
+    import tarfile
+    from aiida.engine import run_get_node
+    from aiida.plugins import CalculationFactory
+
+    with open(os.path.join(tests.TEST_DIR, 'input_files', 'water_se_a.json')) as handle:
+        parameters = json.load(handle)
+    DpCalculation = CalculationFactory('deepmd')
+    data_folder = DpCalculation.get_data_folder([os.path.join(tests.TEST_DIR, 'input_files', 'train_data')])
+
+    inputs = {
+        'code': aiida_local_code_factory(entry_point='deepmd', executable='diff'),
+        'model': orm.Dict(dict=parameters['model']),
+        'learning_rate': orm.Dict(dict=parameters['learning_rate']),
+        'loss': orm.Dict(dict=parameters['loss']),
+        'training': orm.Dict(dict=parameters['training']),
+        'data_folder': data_folder,
+        'metadata': {
+            'dry_run': True,
+            'options': {
+                'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1},
+                'pack_training_data': True,
+            },
+        },
+    }
+    _, node = run_get_node(DpCalculation, **inputs)
+
+    folder = node.dry_run_info['folder']
+    assert 'train_data' not in os.listdir(folder)
+    with tarfile.open(os.path.join(folder, 'training_data.tar')) as archive:
+        assert os.path.join('train_data', 'set.000', 'box.npy') in archive.getnames()
+    with open(os.path.join(folder, node.dry_run_info['script_filename'])) as handle:
+        assert 'tar -xf training_data.tar && rm training_data.tar' in handle.read()
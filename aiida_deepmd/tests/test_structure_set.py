@@ -0,0 +1,644 @@
+""" Tests for the StructureSet data type
+
+"""
+import os
+
+import numpy
+import pytest
+from ase.atoms import Atoms
+
+from aiida_deepmd import tests
+from aiida_deepmd.data.structure_set import StructureSet, _get_raws
+
+
+def random_atoms(natoms, symbols='CuO', seed=0):
+    """Return a random periodic structure with ``natoms`` atoms."""
+    rng = numpy.random.RandomState(seed)
+    numbers = Atoms(symbols * natoms).numbers[:natoms]
+    cell = numpy.diag(rng.uniform(8., 12., 3))
+    positions = rng.uniform(0., 8., (natoms, 3))
+    return Atoms(numbers=numbers, positions=positions, cell=cell, pbc=True)
+
+
+@pytest.fixture
+def structurelist():
+    """A list of structures with different number of atoms."""
+    return [random_atoms(n, seed=i) for i, n in enumerate([4, 8, 12, 4, 16])]
+
+
+def test_set_structurelist(structurelist):
+    """Test the arrays and attributes set by ``set_structurelist``."""
+    sset = StructureSet(structurelist=structurelist)
+
+    assert sset.length == 5
+    assert sset.size == [4, 8, 12, 4, 16]
+    assert sset.get_attribute('elements') == ['O', 'Cu']
+    assert sset.get_positions().shape == (44, 3)
+    assert sset.get_atomic_numbers().shape == (44,)
+    assert sset.get_offsets().tolist() == [0, 4, 12, 24, 28, 44]
+
+
+def test_composition_index(structurelist):
+    """Test the composition attributes set with the collection."""
+    structurelist.append(random_atoms(6, symbols='CHO'))
+    sset = StructureSet(structurelist=structurelist)
+
+    assert sset.get_attribute('formulas') == ['C2H2O2', 'Cu2O2', 'Cu4O4', 'Cu6O6', 'Cu8O8']
+    assert sset.get_formulas() == ['Cu2O2', 'Cu4O4', 'Cu6O6', 'Cu2O2', 'Cu8O8', 'C2H2O2']
+    assert sset.get_formulas()[-1] == structurelist[-1].get_chemical_formula()
+    assert sset.get_attribute('compositions')['Cu4O4'] == {'counts': {'O': 4, 'Cu': 4}, 'natoms': 8, 'number': 1}
+    assert sset.get_attribute('chemical_systems') == {
+        'Cu-O': {'natoms': [4, 8, 12, 16], 'number': 5},
+        'C-H-O': {'natoms': [6], 'number': 1},
+    }
+
+
+def test_composition_filters(structurelist):
+    """Test querying the stored sets by chemical system and number of atoms."""
+    from aiida.orm import QueryBuilder
+
+    small = StructureSet(structurelist=structurelist[:2]).store()
+    large = StructureSet(structurelist=structurelist[2:]).store()
+    other = StructureSet(structurelist=[random_atoms(6, symbols='CHO')]).store()
+
+    def query(*args):
+        filters = StructureSet.get_composition_filters(*args)
+        return sorted(pk for pk, in QueryBuilder().append(StructureSet, filters=filters, project='id').all())
+
+    assert query(['O', 'Cu']) == sorted([small.pk, large.pk])
+    assert query(['O', 'Cu'], 10, 12) == [large.pk]
+    assert query(['O', 'Cu'], None, 8) == sorted([small.pk, large.pk])
+    assert query(['O', 'Cu'], 5, 7) == []
+    assert query(['C', 'H', 'O'], 1, 6) == [other.pk]
+
+
+def test_statistics(structurelist):
+    """Test the summary statistics updated with the labels."""
+    sset = StructureSet(structurelist=structurelist)
+    statistics = sset.get_attribute('statistics')
+    assert statistics['counts'] == {'structures': 5, 'atoms': 44, 'energies': 0, 'forces': 0, 'virials': 0}
+    assert statistics['natoms'] == {'4': 2, '8': 1, '12': 1, '16': 1}
+    assert 'energy_per_atom' not in statistics
+
+    energies = numpy.array([-4., -12., -18., -6., -32.])
+    sset.set_energies(energies)
+    forces = numpy.zeros([44, 3])
+    forces[:, 0] = numpy.arange(44)
+    sset.set_forces(forces)
+
+    statistics = sset.get_attribute('statistics')
+    assert statistics['counts']['energies'] == 5
+    assert statistics['counts']['forces'] == 5
+    assert statistics['energy_per_atom']['all'] == pytest.approx({
+        'min': -2.,
+        'max': -1.,
+        'mean': -1.5,
+        'std': numpy.std([-1., -1.5, -1.5, -1.5, -2.])
+    })
+    assert statistics['energy_per_atom']['formulas']['Cu2O2'] == pytest.approx({
+        'min': -1.5,
+        'max': -1.,
+        'mean': -1.25,
+        'std': 0.25
+    })
+    assert statistics['force_norm']['max'] == 43.
+    # the percentiles are binned, exact to half a bin width
+    assert statistics['force_norm']['p50'] == pytest.approx(21.5, abs=43. / 2**17)
+
+    # the statistics follow the subsets
+    statistics = sset.subset([1, 4], store_provenance=False).get_attribute('statistics')
+    assert statistics['counts'] == {'structures': 2, 'atoms': 24, 'energies': 2, 'forces': 2, 'virials': 0}
+    assert set(statistics['energy_per_atom']['formulas']) == {'Cu4O4', 'Cu8O8'}
+
+
+def test_set_structurelist_mixed_size():
+    """Test that structures with coprime number of atoms keep a flat layout."""
+    sset = StructureSet(structurelist=[random_atoms(31), random_atoms(64)])
+
+    assert sset.get_positions().shape == (95, 3)
+    assert sset.get_offsets().tolist() == [0, 31, 95]
+    assert len(sset.get_structure(1).get_ase()) == 64
+
+
+def test_migrate_frame_layout(structurelist, tmpdir):
+    """Test reading and migrating a node stored with the legacy frame layout."""
+    sset = StructureSet(structurelist=structurelist)
+    nframes = numpy.array([1, 2, 3, 1, 4])
+
+    legacy = StructureSet()
+    legacy.set_attribute('length', 5)
+    legacy.set_attribute('size', sset.size)
+    legacy.set_array('cells', sset.get_cells())
+    legacy.set_array('positions', sset.get_positions().reshape([11, 4, 3]))
+    legacy.set_array('atomic_numbers', sset.get_atomic_numbers().reshape([11, 4]))
+    legacy.set_array('nframes', nframes)
+    legacy.set_array('cnframes', numpy.cumsum(nframes) - nframes)
+    legacy.set_array('indices', numpy.arange(5))
+
+    assert legacy.get_offsets().tolist() == sset.get_offsets().tolist()
+    assert numpy.allclose(legacy.get_structure(2).get_ase().positions, structurelist[2].positions)
+
+    # the attributes added with the offset layout are computed from the arrays
+    assert legacy.get_elements() == ['O', 'Cu']
+    assert legacy.get_formulas() == sset.get_formulas()
+    assert repr(legacy[1]) == '<StructureView: StructureSet[1] Cu4O4>'
+    assert legacy.find_duplicates()[0].tolist() == sset.find_duplicates()[0].tolist()
+    assert numpy.allclose(legacy.get_features(), sset.get_features())
+    assert len(legacy.select_stratified(3, seed=0)) == 3
+    assert len(legacy.export_deepmd(str(tmpdir))) == 4
+
+    migrated = legacy.migrate()
+    assert 'nframes' not in migrated.get_arraynames()
+    assert numpy.array_equal(migrated.get_array('positions'), sset.get_positions())
+    assert migrated.get_offsets().tolist() == sset.get_offsets().tolist()
+
+
+def test_get_structure(structurelist):
+    """Test that structures are recovered unchanged from the set."""
+    sset = StructureSet(structurelist=structurelist)
+
+    for idx, atoms in enumerate(structurelist):
+        recovered = sset.get_structure(idx).get_ase()
+        assert numpy.allclose(recovered.positions, atoms.positions)
+        assert numpy.allclose(recovered.cell, atoms.cell)
+        assert recovered.numbers.tolist() == atoms.numbers.tolist()
+
+    # negative indices count from the end
+    assert numpy.allclose(sset.get_structure(-1).get_ase().positions, structurelist[-1].positions)
+    assert [len(x) for x in sset.get_structures([-2, 0], as_ase=True)] == [4, 4]
+    with pytest.raises(IndexError):
+        sset.get_structure(5)
+    with pytest.raises(IndexError):
+        sset.get_structure(-6)
+
+
+def test_iter_structures(structurelist):
+    """Test the batch retrieval of structures."""
+    sset = StructureSet(structurelist=structurelist)
+
+    structures = sset.get_structures([4, 1], as_ase=True)
+    assert [len(x) for x in structures] == [16, 8]
+    assert numpy.allclose(structures[0].positions, structurelist[4].positions)
+
+    assert [len(x.get_ase()) for x in sset.iter_structures()] == sset.size
+
+
+def test_mmap(structurelist):
+    """Test that arrays can be memory-mapped from the repository."""
+    sset = StructureSet(structurelist=structurelist)
+
+    positions = sset.get_positions(mmap=True)
+    assert isinstance(positions, numpy.memmap)
+    assert numpy.array_equal(positions, sset.get_positions())
+
+    atoms = sset.get_structures([2], as_ase=True, mmap=True)[0]
+    assert numpy.allclose(atoms.positions, structurelist[2].positions)
+
+
+def test_export_deepmd(structurelist, tmpdir):
+    """Test the export of the set into DeePMD-kit systems."""
+    sset = StructureSet(structurelist=structurelist)
+    sset.set_energies(numpy.arange(5.))
+
+    systems = sset.export_deepmd(str(tmpdir), set_size=1)
+    assert sorted(os.path.basename(x) for x in systems) == ['Cu2O2', 'Cu4O4', 'Cu6O6', 'Cu8O8']
+
+    system = str(tmpdir.join('Cu2O2'))
+    assert numpy.loadtxt(os.path.join(system, 'type.raw'), dtype=int).tolist() == [0, 0, 1, 1]
+    assert open(os.path.join(system, 'type_map.raw')).read().split() == ['O', 'Cu']
+    assert sorted(os.listdir(system)) == ['set.000', 'set.001', 'type.raw', 'type_map.raw']
+
+    coord = numpy.load(os.path.join(system, 'set.001', 'coord.npy'))
+    order = numpy.argsort(structurelist[3].numbers, kind='stable')
+    assert coord.shape == (1, 12)
+    assert numpy.allclose(coord.reshape([4, 3]), structurelist[3].positions[order])
+    assert numpy.load(os.path.join(system, 'set.001', 'box.npy')).shape == (1, 9)
+    assert numpy.load(os.path.join(system, 'set.001', 'energy.npy')).tolist() == [3.]
+
+    # a common type map, e.g. for the sets trained together
+    system = sset.export_deepmd(str(tmpdir.join('common')), type_map=['H', 'Cu', 'O'])[0]
+    assert numpy.loadtxt(os.path.join(system, 'type.raw'), dtype=int).tolist() == [1, 1, 2, 2]
+    assert open(os.path.join(system, 'type_map.raw')).read().split() == ['H', 'Cu', 'O']
+    with pytest.raises(ValueError):
+        sset.export_deepmd(str(tmpdir), type_map=['Cu'])
+
+
+def test_from_deepmd_dirs(tmpdir):
+    """Test the import of DeePMD-kit systems."""
+    datadirs = [os.path.join(tests.TEST_DIR, 'input_files', name) for name in ['train_data', 'train_data2']]
+    sset = StructureSet.from_deepmd_dirs(datadirs, type_map=['O', 'H'])
+
+    assert sset.length == 200
+    assert sset.size == [192] * 200
+    assert sset.get_attribute('elements') == ['H', 'O']
+
+    coord = numpy.load(os.path.join(datadirs[1], 'set.000', 'coord.npy'))
+    energy = numpy.load(os.path.join(datadirs[1], 'set.000', 'energy.npy'))
+    atoms = sset.get_structure(150).get_ase()
+    assert numpy.allclose(atoms.positions, coord[50].reshape([-1, 3]))
+    assert atoms.get_chemical_symbols() == ['O'] * 64 + ['H'] * 128
+    assert numpy.allclose(sset.get_energies()[100:], energy)
+
+    # an unknown element, a type out of the type map or no set are rejected
+    for bad_type_map in [['O', 'Xx'], ['O']]:
+        with pytest.raises(ValueError, match='train_data'):
+            StructureSet.from_deepmd_dirs(datadirs[:1], type_map=bad_type_map)
+    tmpdir.join('type.raw').write('0 1\n')
+    with pytest.raises(ValueError, match='no set'):
+        StructureSet.from_deepmd_dirs([str(tmpdir)], type_map=['O', 'H'])
+
+
+def test_forces_virials(structurelist, tmpdir):
+    """Test that forces and virials round-trip through the DeePMD-kit format."""
+    sset = StructureSet(structurelist=structurelist)
+    forces = [numpy.full([len(x), 3], i, dtype=float) for i, x in enumerate(structurelist)]
+    sset.set_energies(numpy.arange(5.))
+    sset.set_forces(forces)
+    sset.set_virials(numpy.arange(45.).reshape([5, 9]))
+
+    assert sset.get_forces().shape == (44, 3)
+    assert numpy.array_equal(sset.get_forces(2), forces[2])
+    assert numpy.array_equal(sset.get_forces(-1), forces[-1])
+    assert numpy.array_equal(sset.get_virials(1).reshape([-1]), numpy.arange(9., 18.))
+    with pytest.raises(ValueError):
+        sset.set_forces(numpy.zeros([43, 3]))
+
+    imported = StructureSet.from_deepmd_dirs(sset.export_deepmd(str(tmpdir)))
+    energies = imported.get_energies().tolist()
+    for idx in range(5):
+        jdx = energies.index(float(idx))
+        assert numpy.array_equal(imported.get_forces(jdx), forces[idx])
+        assert numpy.array_equal(imported.get_virials(jdx), sset.get_virials(idx))
+
+
+def test_subset_split(structurelist):
+    """Test the subset and the random split of the set."""
+    sset = StructureSet(structurelist=structurelist)
+    sset.set_energies(numpy.arange(5.))
+    sset.set_forces(numpy.arange(132.).reshape([44, 3]))
+
+    subset = sset.subset([4, 1], store_provenance=False)
+    assert subset.size == [16, 8]
+    assert subset.get_array('indices').tolist() == [0, 1]
+    assert subset.get_energies().tolist() == [4., 1.]
+    assert numpy.array_equal(subset.get_forces(1), sset.get_forces(1))
+    assert numpy.allclose(subset.get_structure(0).get_ase().positions, structurelist[4].positions)
+
+    # negative indices count from the end, out of range ones are rejected
+    assert sset.subset([-1, 1], store_provenance=False).get_energies().tolist() == [4., 1.]
+    for indices in [[5], [0, -6]]:
+        with pytest.raises(IndexError):
+            sset.subset(indices, store_provenance=False)
+
+    train, validation = sset.split([0.6, 0.4], seed=0, store_provenance=False)
+    assert train.length == 3
+    assert validation.length == 2
+    assert train.get_array('indices').tolist() == [0, 1, 2]
+    assert sorted(train.get_energies().tolist() + validation.get_energies().tolist()) == [0., 1., 2., 3., 4.]
+
+
+def test_merge(structurelist):
+    """Test the merge of sets, including a set with the legacy frame layout."""
+    first = StructureSet(structurelist=structurelist[:2])
+    first.set_energies([0., 1.])
+    second = StructureSet(structurelist=structurelist[2:])
+    second.set_energies([2., 3., 4.])
+
+    legacy = StructureSet()
+    legacy.set_attribute('length', 1)
+    legacy.set_attribute('size', [8])
+    legacy.set_array('cells', first.get_cells()[1:])
+    legacy.set_array('positions', first.get_positions()[4:].reshape([2, 4, 3]))
+    legacy.set_array('atomic_numbers', first.get_atomic_numbers()[4:].reshape([2, 4]))
+    legacy.set_array('nframes', numpy.array([2]))
+    legacy.set_array('cnframes', numpy.array([0]))
+    legacy.set_array('indices', numpy.array([0]))
+
+    merged = StructureSet.merge(first, second, store_provenance=False)
+    assert merged.size == [4, 8, 12, 4, 16]
+    assert merged.get_offsets().tolist() == StructureSet(structurelist=structurelist).get_offsets().tolist()
+    assert merged.get_array('indices').tolist() == [0, 1, 2, 3, 4]
+    assert merged.get_energies().tolist() == [0., 1., 2., 3., 4.]
+    assert numpy.allclose(merged.get_structure(3).get_ase().positions, structurelist[3].positions)
+
+    merged = StructureSet.merge(second, legacy, store_provenance=False)
+    assert merged.size == [12, 4, 16, 8]
+    assert merged.get_energies() is None
+    assert numpy.allclose(merged.get_structure(3).get_ase().positions, structurelist[1].positions)
+
+    # the pks of the structures are kept as they are
+    for structure_set, pks in [(first, [11, 12]), (second, [13, 14, 15])]:
+        structure_set.set_collection(structure_set.get_cells(), structure_set.get_positions(),
+                                     structure_set.get_atomic_numbers(), structure_set.get_offsets(), pks=pks)
+    merged = StructureSet.merge(first, second, store_provenance=False)
+    assert merged.get_pks().tolist() == [11, 12, 13, 14, 15]
+    assert merged.get_array('indices').tolist() == [0, 1, 2, 3, 4]
+    assert merged.subset([1, 3], store_provenance=False).get_pks().tolist() == [12, 14]
+    assert StructureSet.merge(first, legacy, store_provenance=False).get_pks() is None
+
+    # merging subsets gives the positions within the merged set
+    whole = StructureSet.merge(first, second, store_provenance=False)
+    merged = StructureSet.merge(whole.subset([3, 4], store_provenance=False),
+                                whole.subset([0, 2], store_provenance=False),
+                                store_provenance=False)
+    assert merged.get_array('indices').tolist() == [0, 1, 2, 3]
+    assert merged.get_pks().tolist() == [14, 15, 11, 13]
+    assert merged.size == [4, 16, 4, 12]
+
+
+def test_find_duplicates(structurelist):
+    """Test the detection of duplicated structures."""
+    atoms = structurelist[2]
+    perturbed = atoms.copy()
+    perturbed.positions += 1e-5
+    shuffled = atoms[numpy.random.RandomState(0).permutation(len(atoms))]
+    shuffled.positions += shuffled.cell[0]
+
+    sset = StructureSet(structurelist=structurelist + [perturbed, shuffled])
+    unique_indices, duplicate_groups = sset.find_duplicates(tolerance=1e-2)
+
+    assert unique_indices.tolist() == [0, 1, 2, 3, 4]
+    assert duplicate_groups == [[2, 5, 6]]
+
+
+def test_from_iterable(structurelist):
+    """Test the creation of a set from a generator, in chunks."""
+    sset = StructureSet.from_iterable((x for x in structurelist), chunk_size=2)
+    reference = StructureSet(structurelist=structurelist)
+
+    assert sset.size == reference.size
+    assert sset.get_formulas() == reference.get_formulas()
+    for name in ['cells', 'positions', 'atomic_numbers', 'offsets']:
+        assert numpy.array_equal(sset.get_array(name), reference.get_array(name))
+
+    with pytest.raises(ValueError):
+        StructureSet.from_iterable(iter([]))
+
+
+def labelled_set(structurelist):
+    """Return a StructureSet of ``structurelist`` with energies, forces and symmetric virials."""
+    rng = numpy.random.RandomState(0)
+    sset = StructureSet(structurelist=structurelist)
+    sset.set_energies(rng.normal(size=5))
+    sset.set_forces(rng.normal(size=(44, 3)))
+    virials = rng.normal(size=(5, 3, 3))
+    sset.set_virials(virials + virials.transpose([0, 2, 1]))
+    return sset
+
+
+def assert_same_set(imported, sset):
+    """Assert that two sets have the same structures and labels."""
+    assert imported.size == sset.size
+    assert numpy.array_equal(imported.get_atomic_numbers(), sset.get_atomic_numbers())
+    numpy.testing.assert_allclose(imported.get_cells(), sset.get_cells())
+    numpy.testing.assert_allclose(imported.get_positions(), sset.get_positions(), atol=1e-7)
+    numpy.testing.assert_allclose(imported.get_energies(), sset.get_energies())
+    numpy.testing.assert_allclose(imported.get_forces(), sset.get_forces(), atol=1e-7)
+    numpy.testing.assert_allclose(imported.get_virials(), sset.get_virials(), atol=1e-7)
+
+
+def test_extxyz(structurelist, tmpdir):
+    """Test writing and reading an extended XYZ file in chunks."""
+    import ase.io
+
+    sset = labelled_set(structurelist)
+    filename = str(tmpdir.join('structures.xyz'))
+    sset.to_extxyz(filename, chunk_size=2)
+    assert_same_set(StructureSet.from_extxyz(filename, chunk_size=2), sset)
+
+    # the file is readable by ASE
+    frames = ase.io.read(filename, index=':')
+    assert [x.get_chemical_formula() for x in frames] == sset.get_formulas()
+    assert frames[2].get_potential_energy() == pytest.approx(sset.get_energies()[2])
+    numpy.testing.assert_allclose(frames[2].get_forces(), sset.get_forces(2), atol=1e-7)
+
+    # and a file written by ASE is read, its stress converted to virials
+    ase.io.write(filename, frames, format='extxyz')
+    assert_same_set(StructureSet.from_extxyz(filename, chunk_size=3), sset)
+
+    # the labels are dropped if one frame lacks them, at any chunk size
+    frames[1].calc = None
+    ase.io.write(filename, frames[:2], format='extxyz')
+    for chunk_size in [1, 2]:
+        imported = StructureSet.from_extxyz(filename, chunk_size=chunk_size)
+        assert len(imported) == 2
+        assert imported.get_energies() is None
+        assert imported.get_forces() is None
+
+    # trailing blank lines are ignored, blank lines between frames and truncated frames are rejected
+    sset.to_extxyz(filename)
+    lines = open(filename).readlines()
+    natoms = len(structurelist[0])
+    for broken in [
+            lines[:natoms + 2] + ['\n'] + lines[natoms + 2:],
+            lines[:1],
+            lines[:natoms + 1],
+            lines[:natoms + 1] + lines[natoms + 2:],
+    ]:
+        tmpdir.join('broken.xyz').write(''.join(broken))
+        with pytest.raises(ValueError):
+            StructureSet.from_extxyz(str(tmpdir.join('broken.xyz')))
+    tmpdir.join('trailing.xyz').write(''.join(lines + ['\n', '\n']))
+    assert_same_set(StructureSet.from_extxyz(str(tmpdir.join('trailing.xyz'))), StructureSet.from_extxyz(filename))
+
+
+def test_ase_db(structurelist, tmpdir):
+    """Test writing and reading an ASE database in chunks."""
+    sset = labelled_set(structurelist)
+    filename = str(tmpdir.join('structures.db'))
+    assert sset.to_ase_db(filename, chunk_size=2) == [1, 2, 3, 4, 5]
+    assert_same_set(StructureSet.from_ase_db(filename, chunk_size=2), sset)
+    assert StructureSet.from_ase_db(filename, 'natoms>10').size == [12, 16]
+
+
+@pytest.mark.parametrize('reduced_precision,compress', [(True, False), (False, True), (True, True)])
+def test_storage(structurelist, reduced_precision, compress):
+    """Test the reduced precision and compressed storage of the arrays."""
+    reference = StructureSet(structurelist=structurelist)
+    sset = StructureSet(structurelist=structurelist, reduced_precision=reduced_precision, compress=compress)
+    sset.set_forces(numpy.ones([44, 3]))
+
+    positions = sset.get_positions()
+    assert positions.dtype == (numpy.float32 if reduced_precision else numpy.float64)
+    assert sset.get_atomic_numbers().dtype == (numpy.int8 if reduced_precision else numpy.int64)
+    assert numpy.allclose(positions, reference.get_positions(), atol=1e-5)
+    assert numpy.array_equal(sset.get_cells(), reference.get_cells())
+    assert numpy.array_equal(sset.get_forces(3), numpy.ones([4, 3]))
+    assert sset.get_structure(1).get_ase().get_chemical_formula() == 'Cu4O4'
+    assert any(x.endswith('.npz') for x in sset.list_object_names()) == compress
+
+
+@pytest.mark.parametrize('reduced_precision,compress', [(False, True), (True, True)])
+def test_store_compressed(structurelist, reduced_precision, compress):
+    """Test that a compressed set is stored and read back."""
+    from aiida.orm import load_node
+
+    reference = StructureSet(structurelist=structurelist)
+    sset = StructureSet(structurelist=structurelist, reduced_precision=reduced_precision, compress=compress)
+    sset.set_energies(numpy.arange(5.))
+    sset.store()
+
+    loaded = load_node(sset.pk)
+    assert sorted(loaded.get_arraynames()) == [
+        'atomic_numbers', 'cells', 'energies', 'formula_indices', 'indices', 'offsets', 'positions'
+    ]
+    assert numpy.allclose(loaded.get_positions(), reference.get_positions(), atol=1e-5)
+    assert loaded.get_energies().tolist() == [0., 1., 2., 3., 4.]
+    assert loaded.get_structure(1).get_ase().get_chemical_formula() == 'Cu4O4'
+
+
+def test_set_storage(structurelist):
+    """Test that changing the storage policy re-encodes the arrays."""
+    sset = StructureSet(structurelist=structurelist)
+    sset.set_storage(compress=True)
+    assert 'positions.npy' not in sset.list_object_names()
+    sset.set_storage()
+    assert 'positions.npz' not in sset.list_object_names()
+    assert isinstance(sset.get_positions(mmap=True), numpy.memmap)
+
+
+def test_validate(structurelist):
+    """Test that invalid arrays are rejected with the offending structures."""
+    cells, positions, atomic_numbers, size = _get_raws(structurelist)
+    offsets = numpy.concatenate([[0], numpy.cumsum(size)])
+
+    positions[[5, 30]] = numpy.nan
+    with pytest.raises(ValueError, match='positions has non finite values for the structures 1, 4'):
+        StructureSet().set_collection(cells, positions, atomic_numbers, offsets)
+    positions[[5, 30]] = 0.
+
+    cells[3] = 0.
+    with pytest.raises(ValueError, match='cells are singular for the structures 3'):
+        StructureSet().set_collection(cells, positions, atomic_numbers, offsets)
+    cells[3] = numpy.eye(3)
+
+    with pytest.raises(ValueError, match='no atoms to the structures 2'):
+        StructureSet().set_collection(cells, positions, atomic_numbers, offsets[[0, 1, 2, 2, 4, 5]])
+    with pytest.raises(ValueError, match='energies has shape'):
+        StructureSet().set_collection(cells, positions, atomic_numbers, offsets, energies=numpy.zeros(4))
+    with pytest.raises(ValueError, match='atomic_numbers has dtype'):
+        StructureSet().set_collection(cells, positions, atomic_numbers.astype(float), offsets)
+
+    sset = StructureSet()
+    sset.set_collection(cells, positions, atomic_numbers, offsets)
+    with pytest.raises(ValueError, match='forces has non finite values for the structures 0'):
+        sset.set_forces(numpy.full([44, 3], numpy.inf))
+
+    # integer values are cast to float, other kinds are rejected
+    sset.set_energies([0, 1, 2, 3, 4])
+    assert sset.get_energies().dtype == numpy.float64
+    with pytest.raises(ValueError, match='energies has dtype'):
+        sset.set_energies(['a', 'b', 'c', 'd', 'e'])
+    sset = StructureSet()
+    sset.from_raws(numpy.rint(cells).astype(int), positions, atomic_numbers, size)
+    assert sset.get_cells().dtype == numpy.float64
+
+
+def test_find_close_contacts():
+    """Test the detection of atoms too close to each other."""
+    rng = numpy.random.RandomState(0)
+    grid = numpy.stack(numpy.meshgrid(*[numpy.arange(8)] * 3, indexing='ij'), axis=-1).reshape([-1, 3]) * 2.
+    cell = numpy.array([[16., 0., 0.], [4., 16., 0.], [0., 0., 16.]])
+
+    structures = [Atoms('Cu512', positions=numpy.dot(grid / 16. + rng.uniform(0, 0.01, (512, 3)), cell), cell=cell)]
+    collapsed = structures[0].copy()
+    collapsed.positions[10] = collapsed.positions[11] + 0.5
+    structures.append(collapsed)
+    across = structures[0].copy()
+    across.positions[0] = [0.1, 0.1, 0.1]
+    across.positions[511] = across.positions[0] + cell[0] + cell[1] - 0.3
+    structures.append(across)
+    # a cell thinner than the cell-list bins, close to the image of the atom along z
+    structures.append(Atoms('Cu2', positions=[[0., 0., 0.], [2., 2., 0.]], cell=[4., 4., 1.2]))
+    structures.append(Atoms('Cu2', positions=[[0., 0., 0.], [2., 2., 0.]], cell=[4., 4., 2.]))
+
+    sset = StructureSet(structurelist=structures)
+    assert sset.find_close_contacts(1.5).tolist() == [1, 2, 3]
+    assert sset.find_close_contacts(1.5, max_workers=2).tolist() == [1, 2, 3]
+
+
+def test_from_structures_query(structurelist):
+    """Test the creation of a set from StructureData nodes of a group or a query."""
+    from aiida.orm import Group, QueryBuilder, StructureData
+
+    nodes = [StructureData(ase=x).store() for x in structurelist]
+    group = Group(label='structures').store()
+    group.add_nodes(nodes)
+
+    sset = StructureSet.from_structures_query(group)
+    assert sset.size == [4, 8, 12, 4, 16]
+    assert sset.get_pks().tolist() == [x.pk for x in nodes]
+    assert sset.get_array('indices').tolist() == [0, 1, 2, 3, 4]
+    assert numpy.allclose(sset.get_structure(2).get_ase().positions, structurelist[2].positions)
+    assert sset.get_structure(2).get_ase().numbers.tolist() == structurelist[2].numbers.tolist()
+
+    query = QueryBuilder().append(StructureData, filters={'id': {'in': [nodes[1].pk, nodes[4].pk]}},
+                                  project='*').order_by({StructureData: ['id']})
+    assert StructureSet.from_structures_query(query).size == [8, 16]
+
+
+def test_sequence(structurelist):
+    """Test the sequence protocol and the views of the structures."""
+    sset = StructureSet(structurelist=structurelist)
+    sset.set_energies(numpy.arange(5.))
+
+    assert len(sset) == 5
+    assert len(sset[-1]) == 16
+    assert sset[2].energy == 2.
+    assert numpy.array_equal(sset[2].positions, structurelist[2].positions)
+    assert [x.index for x in sset[1:4]] == [1, 2, 3]
+    assert [len(x) for x in sset] == sset.size
+    assert sset[3].get_ase().get_chemical_formula() == 'Cu2O2'
+    with pytest.raises(IndexError):
+        sset[5]  # pylint: disable=pointless-statement
+
+
+def test_array_cache(structurelist):
+    """Test that the decoded arrays are cached with a bounded memory."""
+    sset = StructureSet(structurelist=structurelist)
+
+    positions = sset.get_array('positions')
+    assert sset.get_array('positions') is positions
+    # the cached arrays are shared, so read-only
+    assert not positions.flags.writeable
+    with pytest.raises(ValueError):
+        sset.get_positions()[0] = 0.
+    positions = sset.get_positions().copy()
+    positions[0] = 0.
+
+    sset.set_cache_size(sset.get_array('cells').nbytes)
+    assert sset.get_array('positions') is not sset.get_array('positions')
+    cells = sset.get_cells()
+    assert sset.get_cells() is cells
+    sset.get_array('indices')
+    assert sset.get_cells() is not cells
+
+    sset.set_cache_size(2**20)
+    sset.get_energies()
+    sset.set_energies(numpy.ones(5))
+    assert sset.get_energies().tolist() == [1.] * 5
+    assert sset._cache_nbytes == sum(x.nbytes for x in sset._array_cache.values())  # pylint: disable=protected-access
+
+
+def test_select(structurelist):
+    """Test the farthest point and stratified selections."""
+    structures = [random_atoms(4, seed=i) for i in range(40)] + structurelist[1:3]
+    sset = StructureSet(structurelist=structures)
+    sset.set_energies(numpy.arange(42.))
+
+    assert sset.get_features().shape == (42, 4)
+
+    selected = sset.select_farthest_points(3)
+    assert len(set(selected.tolist())) == 3
+    assert numpy.array_equal(sset.select_farthest_points(5, features=numpy.arange(42.)[:, None]), [0, 41, 20, 10, 30])
+
+    selected = sset.select_stratified(10, nbins=2, seed=0)
+    assert len(selected) == 10
+    assert len(numpy.unique(selected)) == 10
+    # the budget is split in proportion of the 20, 20, 1 and 1 structures of the strata
+    assert (selected < 20).sum() == 5
+    assert (selected >= 40).sum() == 0
+    assert sset.select_stratified(40, nbins=2, seed=0).tolist()[-2:] == [40, 41]
+
+    with pytest.raises(ValueError):
+        sset.select_stratified(43)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Benchmark the construction of a StructureSet from a list of structures.
+
+Usage: verdi run structure_set.py
+
+Times ``StructureSet.set_structurelist`` against the number of structures, and
+compares it with the frame-by-frame copy of the former gcd frame layout for the
+smaller sizes.
+
+Reports the repository size and the read throughput, in frames and decoded
+bytes per second, of an MD-like labelled set for each storage policy of
+``StructureSet.set_storage``.
+
+Times the farthest point and stratified selection of a labelling budget out of
+a million candidate structures.
+
+Reports the throughput in frames per second of the streaming extended XYZ and
+ASE database readers and writers, against ``ase.io.read``.
+"""
+import os
+import tempfile
+import time
+
+import ase.io
+import numpy
+from aiida.orm import load_node
+from ase.atoms import Atoms
+
+from aiida_deepmd.data.structure_set import StructureSet
+
+SIZES = [100, 1000, 10000, 100000]
+LOOP_SIZES = [100, 1000, 10000]
+STORAGE_POLICIES = [
+    {'reduced_precision': False, 'compress': False},
+    {'reduced_precision': True, 'compress': False},
+    {'reduced_precision': False, 'compress': True},
+    {'reduced_precision': True, 'compress': True},
+]
+
+
+def make_structurelist(number_of_structures, seed=0):
+    """Return a list of random structures with 31, 32 or 64 atoms."""
+    rng = numpy.random.RandomState(seed)
+    structurelist = []
+    for natoms in rng.choice([31, 32, 64], number_of_structures):
+        structurelist.append(
+            Atoms(numbers=rng.choice([8, 29], natoms),
+                  positions=rng.uniform(0., 10., (natoms, 3)),
+                  cell=numpy.eye(3) * 10.,
+                  pbc=True))
+    return structurelist
+
+
+def frame_loop(structurelist):
+    """The frame-by-frame copy used by ``set_structurelist`` before vectorization."""
+    from math import gcd
+    from functools import reduce
+
+    number_of_atoms = [len(s) for s in structurelist]
+    frame_size = reduce(gcd, number_of_atoms)
+    nframes = numpy.array([i / frame_size for i in number_of_atoms], dtype=int)
+    cnframes = numpy.cumsum(nframes) - nframes
+
+    arr_positions = numpy.zeros(shape=[sum(nframes), frame_size, 3])
+    arr_atomic_numbers = numpy.zeros(shape=[sum(nframes), frame_size], dtype=int)
+    for i, x in enumerate(structurelist):
+        start = cnframes[i]
+        for j in range(nframes[i]):
+            arr_positions[start + j, :, :] = x.arrays['positions'][j * frame_size:(j + 1) * frame_size, :]
+            arr_atomic_numbers[start + j, :] = x.arrays['numbers'][j * frame_size:(j + 1) * frame_size]
+
+    arr_cells = numpy.array([x.cell for x in structurelist])
+    StructureSet().from_raws(arr_cells, arr_positions, arr_atomic_numbers, number_of_atoms)
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def make_trajectory(number_of_frames=20000, natoms=64, seed=0):
+    """Return the raw arrays of an MD-like trajectory of a Cu-O cell, with energies and forces."""
+    rng = numpy.random.RandomState(seed)
+    lattice = numpy.stack(numpy.meshgrid(*[numpy.arange(4)] * 3, indexing='ij'), axis=-1).reshape([-1, 3])[:natoms]
+    displacements = numpy.cumsum(rng.normal(0., 0.01, (number_of_frames, natoms, 3)), axis=0)
+    positions = (lattice * 2.1 + 0.1 * numpy.tanh(displacements)).reshape([-1, 3])
+    cells = numpy.tile(numpy.eye(3) * 8.4, (number_of_frames, 1, 1))
+    atomic_numbers = numpy.tile(numpy.where(lattice.sum(axis=1) % 2, 8, 29), number_of_frames)
+    energies = -4.5 * natoms + rng.normal(0., 0.1, number_of_frames)
+    forces = rng.normal(0., 0.5, (number_of_frames * natoms, 3))
+    return cells, positions, atomic_numbers, [natoms] * number_of_frames, energies, forces
+
+
+def repository_size(structure_set):
+    """Return the number of bytes of the files of the node."""
+    size = 0
+    for name in structure_set.list_object_names():
+        with structure_set.open(name, mode='rb') as handle:
+            size += len(handle.read())
+    return size
+
+
+def storage():
+    cells, positions, atomic_numbers, size, energies, forces = make_trajectory()
+
+    print('{:>18} {:>9} {:>12} {:>14} {:>20}'.format('reduced/compress', 'MB', 'saved (%)', 'read (frames/s)',
+                                                       'read (decoded MB/s)'))
+    reference = None
+    for policy in STORAGE_POLICIES:
+        structure_set = StructureSet(**policy)
+        structure_set.from_raws(cells, positions, atomic_numbers, size)
+        structure_set.set_energies(energies)
+        structure_set.set_forces(forces)
+        structure_set.store()
+
+        nbytes = repository_size(structure_set)
+        reference = reference or nbytes
+        # a freshly loaded node, so that the arrays are read from the repository, not from the cache
+        loaded = load_node(structure_set.pk)
+        start = time.perf_counter()
+        decoded = sum(loaded.get_array(name).nbytes for name in loaded.get_arraynames())
+        elapsed = time.perf_counter() - start
+        print('{:>18} {:>9.1f} {:>12.1f} {:>14.0f} {:>20.1f}'.format(
+            '{reduced_precision}/{compress}'.format(**policy), nbytes / 1e6, 100. * (1 - nbytes / reference),
+            loaded.length / elapsed, decoded / elapsed / 1e6))
+
+
+def construction():
+    print('{:>10} {:>14} {:>14}'.format('structures', 'vectorized (s)', 'frame loop (s)'))
+    for number_of_structures in SIZES:
+        structurelist = make_structurelist(number_of_structures)
+        vectorized = timeit(StructureSet().set_structurelist, structurelist)
+        loop = timeit(frame_loop, structurelist) if number_of_structures in LOOP_SIZES else float('nan')
+        print('{:>10} {:>14.3f} {:>14.3f}'.format(number_of_structures, vectorized, loop))
+
+
+def selection(number_of_structures=1000000, budget=1000):
+    cells, positions, atomic_numbers, size, energies, _ = make_trajectory(number_of_structures, natoms=2)
+    structure_set = StructureSet()
+    structure_set.from_raws(cells, positions, atomic_numbers, size)
+    structure_set.set_energies(energies)
+
+    start = time.perf_counter()
+    features = structure_set.get_features()
+    print('features of {} structures: {:.3f} s'.format(number_of_structures, time.perf_counter() - start))
+    print('farthest points, {} of {}: {:.3f} s'.format(
+        budget, number_of_structures, timeit(structure_set.select_farthest_points, budget, features)))
+    print('stratified, {} of {}: {:.3f} s'.format(
+        budget, number_of_structures, timeit(structure_set.select_stratified, budget)))
+
+
+def file_formats(number_of_frames=5000):
+    cells, positions, atomic_numbers, size, energies, forces = make_trajectory(number_of_frames)
+    structure_set = StructureSet()
+    structure_set.from_raws(cells, positions, atomic_numbers, size)
+    structure_set.set_energies(energies)
+    structure_set.set_forces(forces)
+
+    def ase_read(filename):
+        StructureSet.from_iterable(ase.io.iread(filename, index=':', format='extxyz'))
+
+    print('{:>24} {:>12}'.format('{} frames'.format(number_of_frames), 'frames/s'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'trajectory.xyz')
+        database = os.path.join(tmpdir, 'trajectory.db')
+        for name, func, arg in [
+            ('to_extxyz', structure_set.to_extxyz, filename),
+            ('from_extxyz', StructureSet.from_extxyz, filename),
+            ('ase.io.iread', ase_read, filename),
+            ('to_ase_db', structure_set.to_ase_db, database),
+            ('from_ase_db', StructureSet.from_ase_db, database),
+        ]:
+            print('{:>24} {:>12.0f}'.format(name, number_of_frames / timeit(func, arg)))
+
+
+def main():
+    construction()
+    print()
+    storage()
+    print()
+    selection()
+    print()
+    file_formats()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Benchmark the submission of a DpCalculation against the number of files of its training data.
+
+Usage: verdi run upload.py
+
+Stores DeePMD-kit systems of small ``set.NNN/*.npy`` files as the ``data_folder`` of a dry-run
+``DpCalculation`` and times its submission: ``prepare_for_submission`` staging the sandbox, then
+its upload to a working directory through the local transport, one ``put`` per file as the SSH
+transport does, with and without the ``pack_training_data`` option. When packed, the timing
+includes the packing in ``prepare_for_submission`` and the unpacking run by the job script.
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+from aiida import orm
+from aiida.common.folders import SandboxFolder
+from aiida.engine.utils import instantiate_process
+from aiida.manage.manager import get_manager
+from aiida.transports.plugins.local import LocalTransport
+
+from aiida_deepmd import tests
+from aiida_deepmd.calculations.dp import DpCalculation
+
+# the label of a configured computer, the code of the calculations is not stored
+COMPUTER = 'localhost'
+FILE_COUNTS = [100, 1000, 10000]
+FILES_PER_SET = ['box.npy', 'coord.npy', 'energy.npy', 'force.npy']
+
+
+def make_systems(basepath, number_of_files, frames=10, natoms=64):
+    """Write systems of ``number_of_files`` files in ``basepath`` and return the system directories."""
+    rng = numpy.random.RandomState(number_of_files)
+    datadirs = set()
+    for i in range(number_of_files // len(FILES_PER_SET)):
+        datadir = os.path.join(basepath, 'system.{:03d}'.format(i // 100))
+        set_dir = os.path.join(datadir, 'set.{:03d}'.format(i % 100))
+        os.makedirs(set_dir)
+        for name in FILES_PER_SET:
+            numpy.save(os.path.join(set_dir, name), rng.normal(size=(frames, natoms)))
+        datadirs.add(datadir)
+    return sorted(datadirs)
+
+
+def upload_files(transport, sandbox, workdir):
+    """Upload the sandbox one file at a time, as the SSH transport puts a tree."""
+    for root, _, filenames in os.walk(sandbox):
+        remote_root = os.path.join(workdir, os.path.relpath(root, sandbox))
+        transport.makedirs(remote_root, ignore_existing=True)
+        for filename in filenames:
+            transport.put(os.path.join(root, filename), os.path.join(remote_root, filename))
+
+
+def submit(transport, inputs, workdir):
+    """Prepare the calculation, upload its sandbox and run the prepend text of its job script."""
+    process = instantiate_process(get_manager().get_runner(), DpCalculation, **inputs)
+    with SandboxFolder() as sandbox:
+        calc_info = process.prepare_for_submission(sandbox)
+        upload_files(transport, sandbox.abspath, workdir)
+    if calc_info.prepend_text:
+        transport.chdir(workdir)
+        retval, _, stderr = transport.exec_command_wait(calc_info.prepend_text)
+        if retval:
+            raise RuntimeError(stderr)
+
+
+def main():
+    with open(os.path.join(tests.TEST_DIR, 'input_files', 'water_se_a.json')) as handle:
+        parameters = json.load(handle)
+    code = orm.Code(input_plugin_name='deepmd', remote_computer_exec=[orm.load_computer(COMPUTER), '/bin/true'])
+
+    print('{:>8} {:>12} {:>12}'.format('files', 'per file (s)', 'packed (s)'))
+    with LocalTransport() as transport:
+        for number_of_files in FILE_COUNTS:
+            datapath = tempfile.mkdtemp()
+            try:
+                data_folder = DpCalculation.get_data_folder(make_systems(datapath, number_of_files))
+            finally:
+                shutil.rmtree(datapath)
+            times = []
+            for packed in [False, True]:
+                inputs = {
+                    'code': code,
+                    'model': orm.Dict(dict=parameters['model']),
+                    'learning_rate': orm.Dict(dict=parameters['learning_rate']),
+                    'loss': orm.Dict(dict=parameters['loss']),
+                    'training': orm.Dict(dict={k: v for k, v in parameters['training'].items() if k != 'systems'}),
+                    'data_folder': data_folder,
+                    'metadata': {
+                        'dry_run': True,
+                        'options': {
+                            'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1},
+                            'pack_training_data': packed,
+                        },
+                    },
+                }
+                workdir = tempfile.mkdtemp()
+                try:
+                    start = time.perf_counter()
+                    submit(transport, inputs, workdir)
+                    times.append(time.perf_counter() - start)
+                finally:
+                    shutil.rmtree(workdir)
+            print('{:>8} {:>12.3f} {:>12.3f}'.format(number_of_files, *times))
+
+
+if __name__ == '__main__':
+    main()
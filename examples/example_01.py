@@ -35,8 +35,9 @@ def test_run(deepmd_code):
         'learning_rate': Dict(dict=train_param["learning_rate"]),
         'loss': Dict(dict=train_param["loss"]),
         'training': Dict(dict=train_param["training"]),
-        'datadirs':["../aiida_deepmd/tests/input_files/train_data/",
-                    "../aiida_deepmd/tests/input_files/train_data2/"],
+        'data_folder': CalculationFactory('deepmd').get_data_folder(
+            ["../aiida_deepmd/tests/input_files/train_data/",
+             "../aiida_deepmd/tests/input_files/train_data2/"]),
         'metadata': {
             'description': "Test job submission with the aiida_deepmd plugin",
             'dry_run': True,